@@ -0,0 +1,466 @@
+import os
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import builtins
+import multiprocessing
+import tempfile
+import platform
+import py_compile
+import subprocess
+from contextlib import redirect_stdout, redirect_stderr
+
+import tasks
+
+
+TASKS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tasks.py')
+CLI_SCRIPT = os.path.join(os.path.dirname(TASKS_SCRIPT), 'cli.py')
+
+scenarios = {}
+
+
+def scenario(name, setup=None):
+    def scenario_decorator(fnc):
+        scenarios[name] = {
+            'fnc': fnc,
+            'setup': setup,
+        }
+        return fnc
+    return scenario_decorator
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark tasks commands on a synthetic tree.')
+    parser.add_argument('--depth', type=int, default=4, help='depth of the generated tree')
+    parser.add_argument('--fanout', type=int, default=8, help='subtasks of every non-leaf task')
+    parser.add_argument('--descr-size', type=int, default=0, help='description length in bytes')
+    parser.add_argument('--timers', type=float, default=0.01, help='fraction of leaves with a running timer')
+    parser.add_argument('--backend', choices=list(tasks.STORES), default='json')
+    parser.add_argument('--repeat', type=int, default=20, help='runs of every scenario')
+    parser.add_argument('--startup-repeat', type=int, default=5, help='one-shot processes for startup timing')
+    parser.add_argument('--startup-budget', type=float, default=50,
+                        help='most milliseconds a one-shot command may add to bare interpreter startup (p50)')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent sessions in the stress scenario')
+    parser.add_argument('--stress-ops', type=int, default=50, help='commands run by every stress session')
+    parser.add_argument('--cold', action='store_true', help='clear the task cache before every run')
+    parser.add_argument('--only', default=None, help='comma separated scenarios to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench-results.json', help='file to save JSON results to')
+    parser.add_argument('--compare', default=None, help='earlier results file to compare against')
+    return parser.parse_args(argv)
+
+
+def generate_records(depth, fanout, descr_size, rng):
+    next_id = 0
+    stack = [(next_id, None, 0, 0)]
+    while stack:
+        task_id, parent_id, order, level = stack.pop()
+        record = {
+            'id': task_id,
+            'parent': parent_id,
+            'order': order,
+            'name': f'task {task_id}',
+            'state': rng.choice([tasks.TODO_STATE, tasks.TODO_STATE, tasks.IN_PROGRESS_STATE, tasks.DONE_STATE]),
+            'time_cost': rng.randint(0, 8),
+            'priority': rng.randint(0, 3),
+        }
+        if descr_size:
+            record['descr'] = 'x' * descr_size
+        yield record
+        if level < depth:
+            children = []
+            for child_order in range(fanout):
+                next_id += 1
+                children.append((next_id, task_id, child_order, level + 1))
+            stack.extend(reversed(children))
+
+
+def build_tree(args, rng):
+    tasks.init(args.backend)
+    tasks.upgrade_tree()
+    config = new_config()
+    with open('tree.jsonl', 'w', encoding='utf-8') as file:
+        tasks.write_records(file, generate_records(args.depth, args.fanout, args.descr_size, rng))
+    quietly(tasks.run_command, 'import', ['tree.jsonl', '0'], config)
+    os.remove('tree.jsonl')
+
+    leaves = []
+    nodes = []
+    for task_id in tasks.get_all_tasks():
+        if task_id == 0:
+            continue
+        (nodes if tasks.read_task(task_id)['tasks'] else leaves).append(task_id)
+    timers = rng.sample(leaves, int(len(leaves) * args.timers))
+    start_timers(timers, config)
+    return {
+        'config': config,
+        'rng': rng,
+        'leaves': leaves,
+        'nodes': nodes or [0],
+        'timers': timers,
+        'created': [],
+        'size': len(leaves) + len(nodes) + 1,
+    }
+
+
+def new_config():
+    config = {'quiet': True, 'anywhere': True, 'assume_yes': True}
+    tasks.init_config(config)
+    return config
+
+
+def start_timers(timers, config):
+    with tasks.transaction():
+        for task_id in timers:
+            quietly(tasks.run_command, 'bwork', [str(task_id)], config)
+
+
+def quietly(fnc, *args):
+    with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
+        return fnc(*args)
+
+
+def run_cmd(ctx, cmd, *params):
+    errors = tasks.error_count
+    quietly(tasks.run_command, cmd, [str(param) for param in params], ctx['config'])
+    if tasks.error_count != errors:
+        raise RuntimeError(f'Command failed: {cmd} {" ".join(map(str, params))}')
+
+
+@scenario('see')
+def bench_see(ctx):
+    run_cmd(ctx, 'see', ctx['rng'].choice(ctx['nodes']))
+
+
+@scenario('new')
+def bench_new(ctx):
+    parent_id = ctx['rng'].choice(ctx['nodes'])
+    tasks.set_current(ctx['config'], parent_id)
+    run_cmd(ctx, 'new', 'bench', 'task')
+    ctx['created'].append(tasks.read_task(parent_id)['tasks'][-1])
+
+
+def setup_rm(ctx):
+    if not ctx['created']:
+        bench_new(ctx)
+
+
+@scenario('rm', setup_rm)
+def bench_rm(ctx):
+    run_cmd(ctx, 'rm', ctx['created'].pop())
+
+
+@scenario('done')
+def bench_done(ctx):
+    task_id = ctx['rng'].choice(ctx['leaves'])
+    state = tasks.read_task(task_id)['state']
+    run_cmd(ctx, 'progr' if state == tasks.DONE_STATE else 'done', task_id)
+
+
+@scenario('cost')
+def bench_cost(ctx):
+    run_cmd(ctx, 'cost', 0)
+
+
+@scenario('todo')
+def bench_todo(ctx):
+    run_cmd(ctx, 'todo', 10)
+
+
+@scenario('sort')
+def bench_sort(ctx):
+    run_cmd(ctx, 'sort', 0)
+
+
+def setup_cd(ctx):
+    task_id = ctx['rng'].choice(ctx['leaves'])
+    path = [tasks.read_task(step_id)['name'] for step_id in tasks.ancestors(task_id)[1:] + [task_id]]
+    ctx['path'] = '/' + '/'.join(path)
+
+
+@scenario('cd', setup_cd)
+def bench_cd(ctx):
+    run_cmd(ctx, 'cd', ctx['path'])
+
+
+@scenario('complete', setup_cd)
+def bench_complete(ctx):
+    line = f'cd {ctx["path"][:-1]}'
+    with tasks.transaction():
+        tasks.complete_line(line, max(line.rfind(' '), line.rfind('/')) + 1, ctx['config'])
+
+
+def setup_end_work(ctx):
+    start_timers(ctx['timers'], ctx['config'])
+
+
+@scenario('end_work', setup_end_work)
+def bench_end_work(ctx):
+    quietly(tasks.end_work_in_all_tasks)
+
+
+class IOCounter:
+    def __init__(self):
+        self.opened = 0
+        self.written = 0
+
+    def __enter__(self):
+        self.wchar = written_chars()
+        self.builtin_open = builtins.open
+        self.os_open = os.open
+        builtins.open = self.count(self.builtin_open)
+        os.open = self.count(self.os_open)
+        return self
+
+    def __exit__(self, *exc):
+        builtins.open = self.builtin_open
+        os.open = self.os_open
+        if self.wchar is not None:
+            self.written = written_chars() - self.wchar
+
+    def count(self, fnc):
+        def counted(*args, **kwargs):
+            self.opened += 1
+            return fnc(*args, **kwargs)
+        return counted
+
+
+def written_chars():
+    try:
+        with open('/proc/self/io', 'r') as file:
+            for line in file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples):
+    return {
+        'runs': len(samples),
+        'p50_ms': percentile(samples, 0.5) * 1000,
+        'p90_ms': percentile(samples, 0.9) * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'max_ms': max(samples) * 1000,
+    }
+
+
+def run_scenario(name, ctx, args):
+    fnc = scenarios[name]['fnc']
+    setup = scenarios[name]['setup']
+    samples = []
+    opened = 0
+    written = 0
+    for _ in range(args.repeat):
+        if setup is not None:
+            setup(ctx)
+        if args.cold:
+            tasks.store.clear()
+        with IOCounter() as counter:
+            start = time.perf_counter()
+            fnc(ctx)
+            samples.append(time.perf_counter() - start)
+        opened += counter.opened
+        written += counter.written
+    result = summarize(samples)
+    result['files_opened'] = opened / args.repeat
+    result['bytes_written'] = written / args.repeat if written_chars() is not None else None
+    return result
+
+
+STRESS_COMMANDS = ['in', 'new', 'new', 'done', 'progr', 'bwork', 'ework', 'up', 'down', 'eval']
+
+
+def stress_worker(seed, ops, nodes, leaves):
+    tasks.open_store()
+    rng = random.Random(seed)
+    config = new_config()
+    samples = []
+    created = 0
+    failed = 0
+    for index in range(ops):
+        cmd = rng.choice(STRESS_COMMANDS)
+        if cmd == 'in':
+            tasks.set_current(config, rng.choice(nodes))
+            continue
+        if cmd == 'new':
+            params = ['stress', str(seed), str(index)]
+        elif cmd == 'eval':
+            params = [str(rng.choice(leaves)), str(rng.randint(0, 8))]
+        else:
+            params = [str(rng.choice(leaves))]
+        errors = tasks.error_count
+        start = time.perf_counter()
+        quietly(tasks.run_command, cmd, params, config)
+        samples.append(time.perf_counter() - start)
+        if tasks.error_count != errors:
+            failed += 1
+        elif cmd == 'new':
+            created += 1
+    quietly(tasks.end_work_in_all_tasks)
+    tasks.store.close()
+    return samples, created, failed
+
+
+def measure_stress(ctx, args):
+    tasks.store.close()
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    jobs = [(args.seed * 1000 + worker, args.stress_ops, ctx['nodes'], ctx['leaves'])
+            for worker in range(args.workers)]
+    with context.Pool(args.workers) as pool:
+        outcomes = pool.starmap(stress_worker, jobs)
+    tasks.open_store()
+    samples = [sample for outcome in outcomes for sample in outcome[0]]
+    result = summarize(samples)
+    result['failed'] = sum(outcome[2] for outcome in outcomes)
+    result['violations'] = check_tree(sum(outcome[1] for outcome in outcomes))
+    return result
+
+
+def check_tree(created):
+    violations = []
+    seen = 0
+    stress_tasks = 0
+    running = set()
+    stack = [0]
+    while stack:
+        task_id = stack.pop()
+        task = tasks.read_task(task_id)
+        seen += 1
+        stress_tasks += task['name'].startswith('stress ')
+        if 'work_time_start' in task:
+            running.add(str(task_id))
+        if not task['tasks']:
+            continue
+        counts = dict.fromkeys(tasks.STATE_COUNT_FIELDS, 0)
+        for subtask_id in task['tasks']:
+            subtask = tasks.read_task(subtask_id)
+            if subtask.get('parent') != task_id:
+                violations.append(f'#{subtask_id} does not point back to its parent #{task_id}')
+            counts[subtask['state']] += 1
+            stack.append(subtask_id)
+        for state, field in tasks.STATE_COUNT_FIELDS.items():
+            if task.get(field, 0) != counts[state]:
+                violations.append(f'#{task_id} counts {task.get(field, 0)} {state} subtasks instead of {counts[state]}')
+        if task['state'] != tasks.derived_state(task):
+            violations.append(f'#{task_id} has state {task["state"]} instead of {tasks.derived_state(task)}')
+    if seen != len(tasks.get_all_tasks()):
+        violations.append(f'{len(tasks.get_all_tasks()) - seen} tasks are not reachable from root')
+    if stress_tasks != created:
+        violations.append(f'{stress_tasks} stress tasks exist but {created} were created')
+    if running != set(tasks.read_timers()):
+        violations.append('Timers index does not match running timers')
+    drifted = []
+    tasks.store.begin()
+    try:
+        tasks.verify_rollups(0, drifted)
+    finally:
+        tasks.store.rollback()
+    if drifted:
+        violations.append(f'Rollups drifted in {len(drifted)} tasks')
+    return violations
+
+
+def time_process(argv, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def measure_startup(args):
+    py_compile.compile(TASKS_SCRIPT)
+    result = summarize(time_process([sys.executable, CLI_SCRIPT, 'todo'], args.startup_repeat))
+    interpreter = summarize(time_process([sys.executable, '-c', 'pass'], args.startup_repeat))
+    result['interpreter_p50_ms'] = interpreter['p50_ms']
+    result['overhead_ms'] = result['p50_ms'] - interpreter['p50_ms']
+    result['budget_ms'] = args.startup_budget
+    result['over_budget'] = result['overhead_ms'] > args.startup_budget
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(TASKS_SCRIPT),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline):
+    print(f'{"scenario":<12} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"opened":>8} {"written":>10}')
+    for name, result in results.items():
+        line = (f'{name:<12} {result["p50_ms"]:>9.2f} {result["p90_ms"]:>9.2f} {result["p99_ms"]:>9.2f} '
+                f'{result.get("files_opened", 0):>8.1f} {result.get("bytes_written") or 0:>10.0f}')
+        old = baseline.get(name)
+        if old is not None and old['p50_ms']:
+            line += f'  x{result["p50_ms"] / old["p50_ms"]:.2f} p50'
+        print(line)
+        if result.get('failed'):
+            print(f'  {result["failed"]} commands failed')
+        if 'overhead_ms' in result:
+            print(f'  {result["overhead_ms"]:.2f} ms over bare interpreter startup, budget {result["budget_ms"]:.2f} ms'
+                  + (' - OVER BUDGET' if result['over_budget'] else ''))
+        for violation in result.get('violations', []):
+            print(f'  {violation}')
+
+
+def main(argv):
+    args = parse_args(argv)
+    names = args.only.split(',') if args.only else list(scenarios) + ['stress', 'startup']
+    for name in names:
+        if name not in scenarios and name not in ('stress', 'startup'):
+            print(f'Unknown scenario {name}! Available: {", ".join(scenarios)}, stress, startup', file=sys.stderr)
+            return 1
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='tasks-bench-') as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            ctx = build_tree(args, random.Random(args.seed))
+            results = {}
+            for name in names:
+                if name in scenarios:
+                    results[name] = run_scenario(name, ctx, args)
+            if 'stress' in names:
+                results['stress'] = measure_stress(ctx, args)
+            if 'startup' in names:
+                tasks.store.close()
+                results['startup'] = measure_startup(args)
+        finally:
+            os.chdir(cwd)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': vars(args),
+        'tasks': ctx['size'],
+        'results': results,
+    }
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    print_results(results, baseline)
+    if results.get('stress', {}).get('violations') or results.get('startup', {}).get('over_budget'):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,6 @@
+import os
+import sys
+import runpy
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+runpy.run_module('tasks', run_name='__main__', alter_sys=True)
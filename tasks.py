@@ -1,14 +1,18 @@
 import os
+import io
 import json
 import sys
-if os.name != 'nt':
-    import readline
 import time
-import emoji
-import sys, tempfile
-from subprocess import call
-import datetime
 import atexit
+import re
+import zlib
+import struct
+import bisect
+import itertools
+import math
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 
 
 TODO_STATE = 'todo'
@@ -20,11 +24,43 @@ TODO_STATE_SYMBOL = ':eight_o’clock:'
 IN_PROGRESS_STATE_SYMBOL = ':wrench:'
 DONE_STATE_SYMBOL = ':check_mark:'
 
+STATE_SYMBOLS = {
+    TODO_STATE: TODO_STATE_SYMBOL,
+    IN_PROGRESS_STATE: IN_PROGRESS_STATE_SYMBOL,
+    DONE_STATE: DONE_STATE_SYMBOL,
+}
+PLAIN_STATE_SYMBOLS = {
+    TODO_STATE: '[ ]',
+    IN_PROGRESS_STATE: '[~]',
+    DONE_STATE: '[x]',
+}
+BUILTIN_EMOJI = {
+    TODO_STATE_SYMBOL: '\U0001f557',
+    IN_PROGRESS_STATE_SYMBOL: '\U0001f527',
+    DONE_STATE_SYMBOL: '\u2714\ufe0f',
+    ':grinning_face:': '\U0001f600',
+    ':up_arrow:': '\u2b06\ufe0f',
+    ':down_arrow:': '\u2b07\ufe0f',
+}
+EMOJI_ALIAS = re.compile(r':[^:\s]+:')
+
 TASKS_DIR = '.tasks'
+TASKS_DB = os.path.join(TASKS_DIR, 'tasks.db')
+LOCK_PATH = os.path.join(TASKS_DIR, 'lock')
+SOCKET_PATH = os.path.join(TASKS_DIR, 'server.sock')
+WORKLOG_PATH = os.path.join(TASKS_DIR, 'worklog.bin')
+SERVER_FLUSH_DELAY = 0.05
 EDITOR = os.environ.get('EDITOR', 'vim')
+CACHE_SIZE = int(os.environ.get('TASKS_CACHE_SIZE', 10000))
+UNDO_DEPTH = int(os.environ.get('TASKS_UNDO_DEPTH', 20))
 
 
 commands = {}
+plain = bool(os.environ.get('TASKS_NO_EMOJI'))
+state_symbols = None
+help_text = None
+stats = None
+profile_path = None
 
 
 def command(name, params, describtion):
@@ -35,46 +71,733 @@ def command(name, params, describtion):
         else:
             help_msg = f'{name} - {describtion}'
         commands[name] = {
-            'help_msg': emoji.emojize(help_msg),
+            'help_msg': help_msg,
+            'params': params_text.split(' ') if params is not None else [],
             'fnc': fnc
         }
         return fnc
     return command_decorator
 
 
+upgrades = {}
+
+
+def upgrade(name):
+    def upgrade_decorator(fnc):
+        upgrades[name] = fnc
+        return fnc
+    return upgrade_decorator
+
+
+def upgrade_tree():
+    applied = store.read_meta('upgrades', [])
+    for name, fnc in upgrades.items():
+        if name not in applied:
+            with transaction():
+                fnc()
+                applied.append(name)
+                store.write_meta('upgrades', applied)
+
+
 def is_initialized():
     return os.path.isdir(TASKS_DIR)
 
 
+error_count = 0
+
+
 def perror(err):
+    global error_count
+    error_count += 1
     print(err, file=sys.stderr)
 
 
+class CommandError(Exception):
+    pass
+
+
+class InputNeeded(Exception):
+    def __init__(self, kind, text=''):
+        super().__init__(kind)
+        self.kind = kind
+        self.text = text
+
+
+def emojize(text):
+    if ':' not in text:
+        return text
+    if plain:
+        for state, symbol in STATE_SYMBOLS.items():
+            text = text.replace(symbol, PLAIN_STATE_SYMBOLS[state])
+        return text
+    for alias, symbol in BUILTIN_EMOJI.items():
+        if alias in text:
+            text = text.replace(alias, symbol)
+    if not EMOJI_ALIAS.search(text):
+        return text
+    import emoji
+    return emoji.emojize(text)
+
+
 def err_die(err):
     perror(err)
     exit(1)
 
 
-def get_task_path(task_id):
-    return os.path.join(TASKS_DIR, f'{task_id}.json')
+class DirectoryStore:
+    name = 'json'
+
+    def __init__(self, tasks_dir):
+        self.tasks_dir = tasks_dir
+        self.journal_path = os.path.join(tasks_dir, 'journal.log')
+        self.pending = None
+        self.savepoints = []
+        self.recover()
+
+    def path(self, task_id):
+        return os.path.join(self.tasks_dir, f'{task_id}.json')
+
+    def load(self, path):
+        if self.pending is not None and path in self.pending:
+            data = self.pending[path]
+            if data is None:
+                raise FileNotFoundError(path)
+            return json.loads(data)
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.loads(file.read())
+
+    def save(self, path, data):
+        if self.pending is not None:
+            if self.savepoints and path not in self.savepoints[-1]:
+                self.savepoints[-1][path] = self.pending.get(path, MISSING)
+            self.pending[path] = data
+        elif data is None:
+            os.remove(path)
+        else:
+            atomic_write(path, data)
+
+    def is_pending(self, path):
+        if self.pending is None or path not in self.pending:
+            return False
+        if self.pending[path] is None:
+            raise FileNotFoundError(path)
+        return True
+
+    def read(self, task_id):
+        return self.load(self.path(task_id))
+
+    def write(self, task_id, task):
+        self.save(self.path(task_id), json.dumps(task))
+
+    def exists(self, task_id):
+        try:
+            return self.is_pending(self.path(task_id)) or os.path.isfile(self.path(task_id))
+        except FileNotFoundError:
+            return False
+
+    def stamp(self, task_id):
+        if self.is_pending(self.path(task_id)):
+            return None
+        stat = os.stat(self.path(task_id))
+        return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+    def remove(self, task_id):
+        self.save(self.path(task_id), None)
+
+    def ids(self):
+        ids = set()
+        for file_name in os.listdir(self.tasks_dir):
+            task_id, ext = os.path.splitext(file_name)
+            if ext == '.json' and task_id.isnumeric():
+                ids.add(int(task_id))
+        for path, data in (self.pending or {}).items():
+            task_id, ext = os.path.splitext(os.path.basename(path))
+            if ext == '.json' and task_id.isnumeric():
+                if data is None:
+                    ids.discard(int(task_id))
+                else:
+                    ids.add(int(task_id))
+        return list(ids)
+
+    def meta_path(self, name):
+        return os.path.join(self.tasks_dir, f'{name}.json')
+
+    def read_meta(self, name, default=None):
+        try:
+            return self.load(self.meta_path(name))
+        except FileNotFoundError:
+            return default
+
+    def write_meta(self, name, value):
+        self.save(self.meta_path(name), json.dumps(value))
+
+    def remove_meta(self, name):
+        self.save(self.meta_path(name), None)
+
+    def meta_names(self):
+        names = []
+        for file_name in os.listdir(self.tasks_dir):
+            name, ext = os.path.splitext(file_name)
+            if ext == '.json' and not name.isnumeric():
+                names.append(name)
+        return names
+
+    def begin(self):
+        if self.pending is None:
+            self.pending = {}
+        else:
+            self.savepoints.append({})
+
+    def commit(self):
+        if self.savepoints:
+            savepoint = self.savepoints.pop()
+            if self.savepoints:
+                for path, data in savepoint.items():
+                    self.savepoints[-1].setdefault(path, data)
+            return
+        pending, self.pending = self.pending, None
+        if not pending:
+            return
+        with open(self.journal_path, 'w', encoding='utf-8') as journal:
+            for path, data in pending.items():
+                journal.write(json.dumps({'file': os.path.basename(path), 'data': data}) + '\n')
+            journal.write(json.dumps({'commit': len(pending)}) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.apply(pending)
+        os.remove(self.journal_path)
+
+    def rollback(self):
+        if self.savepoints:
+            for path, data in self.savepoints.pop().items():
+                if data is MISSING:
+                    self.pending.pop(path, None)
+                else:
+                    self.pending[path] = data
+            return
+        self.pending = None
+
+    def apply(self, changes):
+        for path, data in changes.items():
+            if data is not None:
+                atomic_write(path, data, durable=True)
+            elif os.path.isfile(path):
+                os.remove(path)
+        sync_dir(self.tasks_dir)
+
+    def recover(self):
+        if not os.path.isfile(self.journal_path):
+            return
+        lock = lock_tasks(os.path.join(self.tasks_dir, 'lock'))
+        try:
+            self.replay_journal()
+            self.remove_stale_temp_files()
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def replay_journal(self):
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as journal:
+                records = [json.loads(line) for line in journal.read().splitlines()]
+        except FileNotFoundError:
+            return
+        except ValueError:
+            records = []
+        if records and records[-1].get('commit') == len(records) - 1:
+            self.apply({os.path.join(self.tasks_dir, record['file']): record['data'] for record in records[:-1]})
+        os.remove(self.journal_path)
+
+    def remove_stale_temp_files(self):
+        for file_name in os.listdir(self.tasks_dir):
+            match = re.fullmatch(r'.+\.json\.([0-9]+)\.tmp', file_name)
+            if match and not pid_alive(int(match[1])):
+                os.remove(os.path.join(self.tasks_dir, file_name))
+
+    def is_empty(self):
+        return not self.ids()
+
+    def close(self):
+        pass
+
+    def destroy(self):
+        for task_id in self.ids():
+            self.remove(task_id)
+        for name in self.meta_names():
+            os.remove(self.meta_path(name))
+
+
+MISSING = object()
+
+
+def atomic_write(path, data, durable=False):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(data)
+        if durable:
+            file.flush()
+            os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def sync_dir(path):
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def pid_alive(pid):
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+class SqliteStore:
+    name = 'sqlite'
+
+    def __init__(self, db_path):
+        import sqlite3
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, isolation_level=None)
+        self.depth = 0
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                        'id INTEGER PRIMARY KEY, parent_id INTEGER, data TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_parent_id ON tasks (parent_id)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+    def read(self, task_id):
+        row = self.db.execute('SELECT data FROM tasks WHERE id = ?', (task_id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f'Task {task_id} does not exist!')
+        return json.loads(row[0])
+
+    def write(self, task_id, task):
+        self.db.execute('INSERT INTO tasks (id, parent_id, data) VALUES (?, ?, ?) '
+                        'ON CONFLICT (id) DO UPDATE SET parent_id = excluded.parent_id, data = excluded.data',
+                        (task_id, task.get('parent'), json.dumps(task)))
+
+    def exists(self, task_id):
+        return self.db.execute('SELECT 1 FROM tasks WHERE id = ?', (task_id,)).fetchone() is not None
+
+    def stamp(self, task_id):
+        return self.db.execute('PRAGMA data_version').fetchone()[0]
+
+    def remove(self, task_id):
+        self.db.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
+
+    def ids(self):
+        return [row[0] for row in self.db.execute('SELECT id FROM tasks')]
+
+    def read_meta(self, name, default=None):
+        row = self.db.execute('SELECT data FROM meta WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def write_meta(self, name, value):
+        self.db.execute('INSERT INTO meta (name, data) VALUES (?, ?) '
+                        'ON CONFLICT (name) DO UPDATE SET data = excluded.data',
+                        (name, json.dumps(value)))
+
+    def remove_meta(self, name):
+        self.db.execute('DELETE FROM meta WHERE name = ?', (name,))
+
+    def meta_names(self):
+        return [row[0] for row in self.db.execute('SELECT name FROM meta')]
+
+    def is_empty(self):
+        return self.db.execute('SELECT 1 FROM tasks LIMIT 1').fetchone() is None
+
+    def begin(self):
+        if self.depth:
+            self.db.execute(f'SAVEPOINT level{self.depth}')
+        else:
+            self.db.execute('BEGIN')
+        self.depth += 1
+
+    def commit(self):
+        self.depth -= 1
+        if self.depth:
+            self.db.execute(f'RELEASE level{self.depth}')
+        else:
+            self.db.execute('COMMIT')
+
+    def rollback(self):
+        self.depth -= 1
+        if self.depth:
+            self.db.execute(f'ROLLBACK TO level{self.depth}')
+            self.db.execute(f'RELEASE level{self.depth}')
+        else:
+            self.db.execute('ROLLBACK')
+
+    def close(self):
+        self.db.close()
+
+    def destroy(self):
+        self.close()
+        os.remove(self.db_path)
+
+
+TASK_FIELDS = ('name', 'state', 'tasks', 'parent', 'rank', 'version')
+TASK_SLOTS = frozenset(TASK_FIELDS)
+NO_SUBTASKS = ()
+
+
+class Task:
+    __slots__ = TASK_FIELDS + ('extra',)
+
+    def __init__(self, data=()):
+        self.extra = None
+        for key, value in (data.items() if hasattr(data, 'items') else data):
+            self[key] = value
+
+    def __getitem__(self, key):
+        try:
+            if key in TASK_SLOTS:
+                return getattr(self, key)
+            return self.extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        if key == 'tasks':
+            value = array('I', value) if value else NO_SUBTASKS
+        elif key == 'state':
+            value = sys.intern(value)
+        if key in TASK_SLOTS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[sys.intern(key)] = value
+
+    def __delitem__(self, key):
+        try:
+            if key in TASK_SLOTS:
+                delattr(self, key)
+            else:
+                del self.extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        if key in TASK_SLOTS:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, items):
+        for key, value in (items.items() if hasattr(items, 'items') else items):
+            self[key] = value
+
+    def items(self):
+        for key in TASK_FIELDS:
+            if hasattr(self, key):
+                yield key, getattr(self, key)
+        if self.extra is not None:
+            yield from self.extra.items()
+
+    def copy(self):
+        task = Task()
+        for key in TASK_FIELDS:
+            if hasattr(self, key):
+                setattr(task, key, getattr(self, key))
+        if task.get('tasks'):
+            task.tasks = array('I', task.tasks)
+        if self.extra is not None:
+            task.extra = dict(self.extra)
+        return task
+
+    def to_dict(self):
+        data = dict(self.items())
+        if 'tasks' in data:
+            data['tasks'] = list(data['tasks'])
+        return data
+
+
+class TaskCache:
+    def __init__(self, store, capacity):
+        self.store = store
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.depth = 0
+        self.written = []
+        self.recording = None
+
+    def read(self, task_id):
+        return copy_task(self.peek(task_id))
+
+    def peek(self, task_id):
+        entry = self.entries.get(task_id)
+        if entry is not None:
+            try:
+                if entry[0] == self.store.stamp(task_id):
+                    self.entries.move_to_end(task_id)
+                    return entry[1]
+            except FileNotFoundError:
+                del self.entries[task_id]
+                raise
+        task = Task(self.store.read(task_id))
+        self.remember(task_id, task)
+        return task
+
+    def write(self, task_id, task):
+        if self.recording is not None:
+            self.record_task(task_id)
+        version = self.stored_version(task_id)
+        if task.get('version', 0) != version:
+            raise CommandError(f'Task {task_id} was changed by another session! Try again.')
+        task['version'] = version + 1
+        if not isinstance(task, Task):
+            task = Task(task)
+        self.store.write(task_id, task.to_dict())
+        self.remember(task_id, copy_task(task))
+        if self.written:
+            self.written[-1].add(task_id)
+
+    def stored_version(self, task_id):
+        entry = self.entries.get(task_id)
+        try:
+            if entry is not None and entry[0] == self.store.stamp(task_id):
+                return entry[1].get('version', 0)
+            return self.store.read(task_id).get('version', 0)
+        except FileNotFoundError:
+            return 0
+
+    def remember(self, task_id, task):
+        if self.capacity <= 0:
+            return
+        self.entries[task_id] = (self.store.stamp(task_id), task)
+        self.entries.move_to_end(task_id)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def exists(self, task_id):
+        return self.store.exists(task_id)
+
+    def remove(self, task_id):
+        if self.recording is not None:
+            self.record_task(task_id)
+        self.entries.pop(task_id, None)
+        self.store.remove(task_id)
+
+    def ids(self):
+        return self.store.ids()
+
+    def read_meta(self, name, default=None):
+        return self.store.read_meta(name, default)
+
+    def write_meta(self, name, value):
+        if self.recording is not None and is_undo_meta(name):
+            self.record_meta(name)
+        self.store.write_meta(name, value)
+
+    def remove_meta(self, name):
+        if self.recording is not None and is_undo_meta(name):
+            self.record_meta(name)
+        self.store.remove_meta(name)
+
+    def meta_names(self):
+        return self.store.meta_names()
+
+    def start_recording(self):
+        self.recording = {'tasks': {}, 'meta': {}}
+
+    def stop_recording(self):
+        recording, self.recording = self.recording, None
+        return recording
+
+    def record_task(self, task_id):
+        tasks = self.recording['tasks']
+        if str(task_id) in tasks:
+            return
+        entry = self.entries.get(task_id)
+        try:
+            if entry is not None and entry[0] == self.store.stamp(task_id):
+                tasks[str(task_id)] = entry[1].to_dict()
+            else:
+                tasks[str(task_id)] = self.store.read(task_id)
+        except FileNotFoundError:
+            tasks[str(task_id)] = None
+
+    def record_meta(self, name):
+        meta = self.recording['meta']
+        if name not in meta:
+            meta[name] = self.store.read_meta(name)
+
+    def begin(self):
+        self.depth += 1
+        self.written.append(set())
+        self.store.begin()
+
+    def commit(self):
+        self.depth -= 1
+        self.store.commit()
+        written = self.written.pop()
+        if self.written:
+            self.written[-1].update(written)
+            return
+        for task_id in written:
+            if task_id in self.entries and self.store.exists(task_id):
+                self.entries[task_id] = (self.store.stamp(task_id), self.entries[task_id][1])
+
+    def rollback(self):
+        self.depth -= 1
+        self.store.rollback()
+        for task_id in self.written.pop():
+            self.entries.pop(task_id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def close(self):
+        self.clear()
+        self.store.close()
+
+
+def copy_task(task):
+    return task.copy()
+
+
+STORES = {
+    DirectoryStore.name: lambda: DirectoryStore(TASKS_DIR),
+    SqliteStore.name: lambda: SqliteStore(TASKS_DB),
+}
+
+
+store = None
+
+
+def detect_backend():
+    if os.path.isfile(TASKS_DB):
+        return SqliteStore.name
+    return DirectoryStore.name
+
+
+def open_store(backend=None):
+    global store
+    detected = detect_backend()
+    if backend is None:
+        backend = os.environ.get('TASKS_BACKEND', detected)
+    if backend not in STORES:
+        err_die(f'Unknown backend {backend}! Available: {", ".join(STORES)}')
+    store = STORES[backend]()
+    if detected != backend:
+        old_store = STORES[detected]()
+        if store.is_empty() and not old_store.is_empty():
+            migrate_store(old_store, store)
+            print(f'Migrated tasks from {old_store.name} to {store.name} backend.')
+            old_store.destroy()
+        else:
+            old_store.close()
+    store = TaskCache(store, CACHE_SIZE)
+
+
+def migrate_store(src, dst):
+    dst.begin()
+    for task_id in src.ids():
+        dst.write(task_id, src.read(task_id))
+    for name in src.meta_names():
+        dst.write_meta(name, src.read_meta(name))
+    dst.commit()
+
+
+commit_hooks = []
+
+
+def on_commit(fnc):
+    commit_hooks.append(fnc)
+    return fnc
+
+
+@contextmanager
+def transaction():
+    lock = lock_tasks() if store.depth == 0 else None
+    work_mark = len(logged_work)
+    blob_mark = len(blob_ref_changes)
+    pending_marks = [(pending, len(pending)) for pending in (blob_tasks, queued_tasks, index_changes)]
+    try:
+        store.begin()
+        try:
+            yield
+            if store.depth == 1:
+                for hook in commit_hooks:
+                    hook()
+        except BaseException:
+            store.rollback()
+            del logged_work[work_mark:]
+            name_indexes.clear()
+            del blob_ref_changes[blob_mark:]
+            for pending, size in pending_marks:
+                while len(pending) > size:
+                    pending.popitem()
+            raise
+        store.commit()
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def lock_tasks(path=LOCK_PATH):
+    if os.name == 'nt':
+        return None
+    import fcntl
+    lock = open(path, 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
 
 
 def get_all_tasks():
-    return [int(task_id.split('.')[0]) for task_id in os.listdir(TASKS_DIR)]
+    return store.ids()
 
 
 def read_task(task_id):
-    with open(get_task_path(task_id), 'r', encoding='utf-8') as file:
-        return json.loads(file.read())
+    return store.read(task_id)
+
+
+def peek_task(task_id):
+    return store.peek(task_id)
 
 
 def write_task(task_id, task):
-    with open(get_task_path(task_id), 'w', encoding='utf-8') as file:
-        file.write(json.dumps(task))
+    track_blobs(task_id)
+    store.write(task_id, task)
+    queue_task(task_id)
+    forget_renamed(task_id, task)
 
 
 def task_exists(task_id):
-    return os.path.isfile(get_task_path(task_id))
+    return store.exists(task_id)
+
+
+def remove_task(task_id):
+    track_blobs(task_id)
+    store.remove(task_id)
+    queue_task(task_id)
 
 
 def empty_task(name):
@@ -84,9 +807,11 @@ def empty_task(name):
         'tasks': []
     }
 
-def init():
+def init(backend=None):
     os.mkdir(TASKS_DIR)
-    write_task(0, empty_task('root'))
+    open_store(backend)
+    with transaction():
+        write_task(0, empty_task('root'))
 
 
 def init_config(config):
@@ -95,12 +820,54 @@ def init_config(config):
     config['name_history'] = ['root']
 
 
+ID_CHUNK_SIZE = 64
+
+
+def read_ids():
+    ids = store.read_meta('ids')
+    if ids is not None:
+        ids.setdefault('chunks', 0)
+    return ids
+
+
+def write_ids(ids):
+    while len(ids['free']) > ID_CHUNK_SIZE:
+        store.write_meta(f'ids-{ids["chunks"]}', ids['free'][:ID_CHUNK_SIZE])
+        del ids['free'][:ID_CHUNK_SIZE]
+        ids['chunks'] += 1
+    store.write_meta('ids', ids)
+
+
+def pop_free_id(ids):
+    if not ids['free'] and ids['chunks']:
+        ids['chunks'] -= 1
+        name = f'ids-{ids["chunks"]}'
+        ids['free'] = store.read_meta(name, [])
+        store.remove_meta(name)
+    return ids['free'].pop() if ids['free'] else None
+
+
 def available_id():
-    ids = [int(os.path.basename(id_name).split('.')[0]) for id_name in os.listdir(TASKS_DIR)]
-    ids.sort()
-    for new_id in range(max(ids) + 2):
-        if new_id not in ids:
-            return new_id
+    ids = read_ids()
+    if ids is None:
+        ids = {'next': max(get_all_tasks()) + 1, 'free': [], 'chunks': 0}
+    while True:
+        new_id = pop_free_id(ids)
+        if new_id is None:
+            new_id = ids['next']
+            ids['next'] += 1
+        if not task_exists(new_id) and not work_logged(new_id):
+            break
+    write_ids(ids)
+    return new_id
+
+
+def release_ids(task_ids):
+    ids = read_ids()
+    if ids is None:
+        return
+    ids['free'].extend(task_id for task_id in task_ids if task_id < ids['next'])
+    write_ids(ids)
 
 
 def is_task_id(params):
@@ -108,18 +875,141 @@ def is_task_id(params):
 
 
 def task_state_symbol(state) :
-    if state == TODO_STATE:
-        return TODO_STATE_SYMBOL
-    elif state == IN_PROGRESS_STATE:
-        return IN_PROGRESS_STATE_SYMBOL
-    elif state == DONE_STATE:
-        return DONE_STATE_SYMBOL
+    global state_symbols
+    if state_symbols is None:
+        state_symbols = {state: emojize(symbol) for state, symbol in STATE_SYMBOLS.items()}
+    return state_symbols[state]
 
 
 def current(config):
     return config['history'][-1]
 
 
+def ancestors(task_id):
+    path = []
+    parent_id = peek_task(task_id).get('parent')
+    while parent_id is not None:
+        path.append(parent_id)
+        parent_id = peek_task(parent_id).get('parent')
+    path.reverse()
+    return path
+
+
+def set_current(config, task_id):
+    config['history'] = ancestors(task_id) + [task_id]
+    config['name_history'] = [read_task(history_id)['name'] for history_id in config['history']]
+    config['current'] = read_task(task_id)
+
+
+NAME_INDEX_SIZE = 64
+
+name_indexes = OrderedDict()
+
+
+def child_names(parent_id):
+    parent = peek_task(parent_id)
+    entry = name_indexes.get(parent_id)
+    if entry is None or entry['version'] != parent.get('version'):
+        names = {child_id: peek_task(child_id)['name'] for child_id in parent['tasks']}
+        entry = {
+            'version': parent.get('version'),
+            'names': names,
+            'sorted': sorted((name, child_id) for child_id, name in names.items()),
+        }
+        name_indexes[parent_id] = entry
+    name_indexes.move_to_end(parent_id)
+    while len(name_indexes) > NAME_INDEX_SIZE:
+        name_indexes.popitem(last=False)
+    return entry
+
+
+def forget_renamed(task_id, task):
+    parent_id = task.get('parent')
+    entry = name_indexes.get(parent_id)
+    if entry is not None and entry['names'].get(task_id) != task['name']:
+        del name_indexes[parent_id]
+
+
+def names_with_prefix(parent_id, prefix):
+    entries = child_names(parent_id)['sorted']
+    start = bisect.bisect_left(entries, (prefix,))
+    matches = []
+    for name, child_id in itertools.islice(entries, start, None):
+        if not name.startswith(prefix):
+            break
+        matches.append((name, child_id))
+    return matches
+
+
+def find_child(parent_id, name):
+    matches = [child_id for child_name, child_id in names_with_prefix(parent_id, name) if child_name == name]
+    if any(peek_task(child_id)['name'] != name for child_id in matches):
+        name_indexes.pop(parent_id, None)
+        return find_child(parent_id, name)
+    return matches
+
+
+def resolve_path(path, config):
+    history = list(config['history'])
+    name_history = list(config['name_history'])
+    parts = path.split('/')
+    if parts[0] in ('', config['name_history'][0]):
+        del history[1:], name_history[1:]
+        parts = parts[1:]
+    for part in parts:
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            if len(history) == 1:
+                return 'Cannot go above root task!'
+            history.pop()
+            name_history.pop()
+            continue
+        names = child_names(history[-1])['names']
+        if part.isnumeric() and int(part) in names:
+            matches = [int(part)]
+        else:
+            matches = find_child(history[-1], part)
+        if not matches:
+            return f'Task {part} not found in {name_history[-1]}!'
+        if len(matches) > 1:
+            ids = ', '.join(f'#{child_id}' for child_id in matches)
+            return f'Name {part} matches tasks {ids}! Use an id.'
+        history.append(matches[0])
+        name_history.append(names[matches[0]])
+    return history, name_history
+
+
+@upgrade('parents')
+def upgrade_parents():
+    stack = [0]
+    while stack:
+        task_id = stack.pop()
+        for subtask_id in read_task(task_id)['tasks']:
+            subtask = read_task(subtask_id)
+            subtask['parent'] = task_id
+            write_task(subtask_id, subtask)
+            stack.append(subtask_id)
+    timers = read_timers()
+    for timer in timers.values():
+        timer.pop('path', None)
+    store.write_meta('timers', timers)
+
+
+def refresh_current(config):
+    if 'current' in config:
+        config['current'] = read_task(current(config))
+
+
+def refresh_stale_current(config):
+    for task_id in reversed(config['history']):
+        if task_exists(task_id):
+            break
+    task = read_task(task_id)
+    if task_id != current(config) or task.get('version') != config['current'].get('version'):
+        set_current(config, task_id)
+
+
 def id_from(params):
     return int(params[0])
 
@@ -140,20 +1030,46 @@ def see(params, config):
             return
 
     if task_exists(task_id):
-        task = read_task(task_id)
+        task = peek_task(task_id)
 
-        for subtask_id in task['tasks']:
-            subtask = read_task(subtask_id)
-            print_task(subtask_id, subtask)
+        lines = [format_task(subtask_id, peek_task(subtask_id)) + '\n' for subtask_id in task['tasks']]
+        sys.stdout.write(''.join(lines))
     else:
         perror(f'Task {task_id} does not exist!')
 
 
-def print_task(task_id, task):
+def show_current(config):
+    if not config.get('quiet'):
+        see([], config)
+
+
+def confirm(config):
+    if config.get('assume_yes'):
+        return True
+    if 'answer' in config:
+        return config['answer'].lower() == 'y'
+    raise InputNeeded('confirm')
+
+
+def ask_user(kind, text):
+    if kind == 'confirm':
+        return input('Are you sure (Y/N)? ')
+    import tempfile
+    from subprocess import call
+    with tempfile.NamedTemporaryFile(suffix=".tmp") as tf:
+        tf.write(text.encode('utf-8'))
+        tf.flush()
+        call([EDITOR, tf.name])
+        tf.seek(0)
+        return tf.read().decode('utf-8')
+
+
+def format_task(task_id, task, name=None):
     state_symbol = task_state_symbol(task['state'])
     task_count = len(task['tasks'])
-    name = task['name']
-    print(emoji.emojize(f'#{task_id} {state_symbol} ({task_count}) {name}'))
+    if name is None:
+        name = task['name']
+    return f'#{task_id} {state_symbol} ({task_count}) {emojize(name)}'
 
 
 def get_id_error_msg(params, config) :
@@ -164,11 +1080,15 @@ def get_id_error_msg(params, config) :
     task_id = id_from(params)
     if not task_exists(task_id):
         return f'Task {task_id} does not exist!'
-    if task_id not in config['current']['tasks']:
+    if not is_child_of_current(task_id, config):
         return f'Task {task_id} is not a child of current task!'
     return None
 
 
+def is_child_of_current(task_id, config):
+    return config.get('anywhere') or task_id in config['current']['tasks']
+
+
 @command('in', 'id', 'Make subtask current task')
 def go_in(params, config, print_see=True):
     error_msg = get_id_error_msg(params, config)
@@ -185,7 +1105,7 @@ def go_in(params, config, print_see=True):
     config['history'].append(task_id)
     config['name_history'].append(task['name'])
     if print_see:
-        see([], config)
+        show_current(config)
 
 
 @command('out', None, 'Make parent current task')
@@ -197,7 +1117,7 @@ def go_out(params, config, print_see=True):
     else:
         perror('Cannot out of root task!')
     if print_see:
-        see([], config)
+        show_current(config)
 
 
 @command('new', 'name', 'Create new task')
@@ -208,11 +1128,10 @@ def new_task(params, config):
 
     task_id = available_id()
     task = empty_task(' '.join(params))
-    config['current']['tasks'].append(task_id)
     write_task(task_id, task)
-    write_task(current(config), config['current'])
-    start_state_propagation(config)
-    see([], config)
+    index_task(task_id)
+    attach_subtask(current(config), task_id, config)
+    show_current(config)
 
 
 @command('rm', 'id', 'Remove task')
@@ -229,24 +1148,25 @@ def rm_task(params, config):
         perror(f'Task {task_id} does not exist!')
         return
     
-    is_sure = input('Are you sure (Y/N)? ')
-    if is_sure.lower() == 'y':
-        rm_subtask(task_id, current(config))
-        config['current']['tasks'].remove(task_id)
-    see([], config)
-
-
-def rm_subtask(subtask_id, parent_id):
-    subtask = read_task(subtask_id)
-
-    for subsubtask_id in subtask['tasks']:
-        rm_subtask(subsubtask_id, subtask_id)
-    
-    parent = read_task(parent_id)
-    parent['tasks'].remove(subtask_id)
-    write_task(parent_id, parent)
-
-    os.remove(get_task_path(subtask_id))
+    if confirm(config):
+        detach_subtask(read_task(task_id)['parent'], task_id, config)
+        removed = rm_subtask(task_id)
+        release_ids(removed)
+        forget_timers(removed)
+    show_current(config)
+
+
+def rm_subtask(subtask_id):
+    removed = []
+    stack = [subtask_id]
+    while stack:
+        task_id = stack.pop()
+        task = peek_task(task_id)
+        stack.extend(task['tasks'])
+        index_task(task_id)
+        remove_task(task_id)
+        removed.append(task_id)
+    return removed
 
 
 def set_task_state(task_id, state, config):
@@ -256,39 +1176,53 @@ def set_task_state(task_id, state, config):
         perror(f'Cannot change state of task with subtasks!')
         return
 
+    old = summary(task)
     task['state'] = state
     write_task(task_id, task)
-    start_state_propagation(config)
+    update_ancestors(task.get('parent'), old, summary(task), config)
 
 
-def start_state_propagation(config):
-    propagate_state(len(config['history']) - 1, config)
+STATE_COUNT_FIELDS = {
+    TODO_STATE: 'todo_count',
+    IN_PROGRESS_STATE: 'progr_count',
+    DONE_STATE: 'done_count',
+}
 
 
-def all_are_done(states):
-    for state in states:
-        if state != DONE_STATE:
-            return False
-    return True
+def count_state(task, state, change):
+    field = STATE_COUNT_FIELDS[state]
+    task[field] = task.get(field, 0) + change
 
 
-def propagate_state(history_id, config):
-    if history_id >= 0:
-        task_id = config['history'][history_id]
-        task = read_task(task_id)
-        states = []
+def clear_state_counts(task):
+    for field in STATE_COUNT_FIELDS.values():
+        task.pop(field, None)
+
+
+def derived_state(task):
+    done_count = task.get('done_count', 0)
+    if done_count == len(task['tasks']):
+        return DONE_STATE
+    elif done_count or task.get('progr_count', 0):
+        return IN_PROGRESS_STATE
+    else:
+        return TODO_STATE
+
+
+def count_states(task_id):
+    task = read_task(task_id)
+    if task['tasks']:
+        clear_state_counts(task)
         for subtask_id in task['tasks']:
-            subtask = read_task(subtask_id)
-            states.append(subtask['state'])
-        if all_are_done(states):
-            curr_state = DONE_STATE
-        elif DONE_STATE in states or IN_PROGRESS_STATE in states:
-            curr_state = IN_PROGRESS_STATE
-        else:
-            curr_state = TODO_STATE
-        task['state'] = curr_state
+            count_state(task, count_states(subtask_id), 1)
+        task['state'] = derived_state(task)
         write_task(task_id, task)
-        propagate_state(history_id - 1, config)
+    return task['state']
+
+
+@upgrade('state_counts')
+def upgrade_state_counts():
+    count_states(0)
 
 
 @command('progr', 'id', f'Set task state to IN PROGRESS {IN_PROGRESS_STATE_SYMBOL}')
@@ -303,7 +1237,7 @@ def set_in_progr(params, config):
         return
     
     set_task_state(task_id, IN_PROGRESS_STATE, config)
-    see([], config)
+    show_current(config)
 
 
 @command('done', 'id', f'Set task state to DONE {DONE_STATE_SYMBOL}')
@@ -318,7 +1252,7 @@ def set_done(params, config):
         return
     
     set_task_state(task_id, DONE_STATE, config)
-    see([], config)
+    show_current(config)
 
 
 @command('reset', 'id', f'Reset task and its children state to TODO {TODO_STATE_SYMBOL}')
@@ -332,11 +1266,11 @@ def reset(params, config):
         perror(f'Task {task_id} does not exist!')
         return
 
-    is_sure = input('Are you sure (Y/N)? ')
-    if is_sure.lower() == 'y':
-        reset_task(task_id)
-        start_state_propagation(config)
-    see([], config)
+    if confirm(config):
+        old = summary(read_task(task_id))
+        task = reset_task(task_id)
+        update_ancestors(task.get('parent'), old, summary(task), config)
+    show_current(config)
 
 
 def reset_task(task_id):
@@ -344,7 +1278,11 @@ def reset_task(task_id):
     for subtask_id in task['tasks']:
         reset_task(subtask_id)
     task['state'] = TODO_STATE
+    if task['tasks']:
+        clear_state_counts(task)
+        task['todo_count'] = len(task['tasks'])
     write_task(task_id, task)
+    return task
 
 
 @command('descr', '[id]', 'Write description for task')
@@ -360,17 +1298,11 @@ def descr(params, config):
         perror(f'Task {task_id} does not exist!')
         return
     task = read_task(task_id)
-    with tempfile.NamedTemporaryFile(suffix=".tmp") as tf:
-        tf.write(task['descr'].encode('utf-8') if 'descr' in task else b'')
-        tf.flush()
-        call([EDITOR, tf.name])
-        tf.seek(0)
-        describtion = tf.read().decode('utf-8')
-        if describtion == '':
-            task.pop('descr', None)
-        else:
-            task['descr'] = describtion
-        write_task(task_id, task)
+    if 'answer' not in config:
+        raise InputNeeded('edit', read_descr(task))
+    set_descr(task, config['answer'])
+    write_task(task_id, task)
+    index_task(task_id)
 
 
 @command('info', '[id]', 'Read description for task')
@@ -390,42 +1322,166 @@ def info(params, config):
 
 
 def print_info(task, divider=None):
-    if 'descr' in task:
+    describtion = read_descr(task)
+    if describtion:
         if divider is not None:
             print(divider)
-        print(emoji.emojize(task['descr']))
+        print(emojize(describtion))
 
 
-@command('pull', 'id', 'Pulls task from this task to outer task')
-def pull(params, config):
-    curr = current(config)
-    if curr == 0:
-        perror("Cannot pull from root task!")
+BLOB_COMPRESS_SIZE = 512
+BLOB_CACHE_SIZE = 64
+
+blob_cache = OrderedDict()
+
+
+def read_descr(task):
+    if 'descr_hash' in task:
+        return read_blob(task['descr_hash'])
+    return task.get('descr', '')
+
+
+def set_descr(task, describtion):
+    task.pop('descr', None)
+    if describtion:
+        task['descr_hash'] = write_blob(describtion)
+        task['descr_size'] = len(describtion)
+    else:
+        task.pop('descr_hash', None)
+        task.pop('descr_size', None)
+
+
+def write_blob(text):
+    import hashlib
+    data = text.encode('utf-8')
+    blob_hash = hashlib.sha256(data).hexdigest()
+    value = {'text': text}
+    if len(data) >= BLOB_COMPRESS_SIZE:
+        import base64
+        packed = base64.b64encode(zlib.compress(data, 9)).decode('ascii')
+        if len(packed) < len(data):
+            value = {'zlib': packed}
+    store.write_meta(f'blob-{blob_hash}', value)
+    count_blob(blob_hash, 0)
+    remember_blob(blob_hash, text)
+    return blob_hash
+
+
+def read_blob(blob_hash):
+    text = blob_cache.get(blob_hash)
+    if text is None:
+        value = store.read_meta(f'blob-{blob_hash}', {'text': ''})
+        if 'zlib' in value:
+            import base64
+            text = zlib.decompress(base64.b64decode(value['zlib'])).decode('utf-8')
+        else:
+            text = value['text']
+        remember_blob(blob_hash, text)
+    return text
+
+
+def remember_blob(blob_hash, text):
+    blob_cache[blob_hash] = text
+    blob_cache.move_to_end(blob_hash)
+    while len(blob_cache) > BLOB_CACHE_SIZE:
+        blob_cache.popitem(last=False)
+
+
+@upgrade('descr_blobs')
+def upgrade_descr_blobs():
+    for task_id in get_all_tasks():
+        task = read_task(task_id)
+        if 'descr' in task:
+            set_descr(task, task['descr'])
+            write_task(task_id, task)
+
+
+blob_tasks = {}
+blob_ref_changes = []
+
+
+def stored_blob(task_id):
+    try:
+        return peek_task(task_id).get('descr_hash')
+    except FileNotFoundError:
+        return None
+
+
+def track_blobs(task_id):
+    if task_id not in blob_tasks:
+        blob_tasks[task_id] = stored_blob(task_id)
+
+
+def count_blob(blob_hash, change):
+    if blob_hash is not None:
+        blob_ref_changes.append((blob_hash, change))
+
+
+def count_step_blobs(step, change):
+    for data in step['tasks'].values():
+        if data is not None:
+            count_blob(data.get('descr_hash'), change)
+
+
+@on_commit
+def flush_blob_refs():
+    for task_id, old_hash in blob_tasks.items():
+        new_hash = stored_blob(task_id)
+        if old_hash != new_hash:
+            count_blob(old_hash, -1)
+            count_blob(new_hash, 1)
+    blob_tasks.clear()
+    changes = {}
+    for blob_hash, change in blob_ref_changes:
+        changes[blob_hash] = changes.get(blob_hash, 0) + change
+    blob_ref_changes.clear()
+    if not changes:
         return
+    refs = PagedIndex('blob_refs')
+    for blob_hash, change in sorted(changes.items()):
+        entry = next(refs.iterate([blob_hash]), None)
+        count = entry[1] if entry is not None and entry[0] == blob_hash else 0
+        if change and count:
+            refs.remove([blob_hash, count])
+        if count + change <= 0:
+            store.remove_meta(f'blob-{blob_hash}')
+            blob_cache.pop(blob_hash, None)
+        elif change:
+            refs.insert([blob_hash, count + change])
+    refs.save()
+
+
+@upgrade('blob_refs')
+def upgrade_blob_refs():
+    for task_id in get_all_tasks():
+        count_blob(stored_blob(task_id), 1)
+    history = store.read_meta('undo')
+    if history is not None:
+        for step_id in history['undo'] + history['redo']:
+            count_step_blobs(store.read_meta(f'undo-{step_id}'), 1)
+    referenced = {blob_hash for blob_hash, change in blob_ref_changes}
+    for name in store.meta_names():
+        if name.startswith('blob-') and name[len('blob-'):] not in referenced:
+            store.remove_meta(name)
+    for blob_hash, count in PagedIndex('blob_refs').iterate():
+        count_blob(blob_hash, -count)
 
+
+@command('pull', 'id', 'Pulls task from this task to outer task')
+def pull(params, config):
     error_msg = get_id_error_msg(params, config)
     if error_msg is not None:
         perror(error_msg)
         return
     task_id = id_from(params)
-
-    if not task_exists(task_id):
-        perror(f'Task {task_id} does not exist!')
+    parent_id = read_task(task_id).get('parent')
+    if parent_id in (None, 0):
+        perror("Cannot pull from root task!")
         return
-    
-    parent = config['current']
 
-    grand_parent_id = config['history'][-2]
-    grand_parent = read_task(config['history'][-2])
-
-    parent['tasks'].remove(task_id)
-    grand_parent['tasks'].append(task_id)
-
-    write_task(curr, parent)
-    write_task(grand_parent_id, grand_parent)
-
-    start_state_propagation(config)
-    see([], config)
+    detach_subtask(parent_id, task_id, config)
+    attach_subtask(read_task(parent_id)['parent'], task_id, config)
+    show_current(config)
 
 
 def are_params_ids(params):
@@ -447,10 +1503,13 @@ def push(params, config):
     task1_id = int(params[0])
     task2_id = int(params[1])
 
-    if task1_id not in config['current']['tasks']:
+    if task1_id == task2_id:
+        perror('Cannot push task into itself!')
+        return
+    if not is_child_of_current(task1_id, config):
         perror(f'Task {task1_id} is not a child of current task!')
         return
-    if task2_id not in config['current']['tasks']:
+    if not is_child_of_current(task2_id, config):
         perror(f'Task {task2_id} is not a child of current task!')
         return
     if not task_exists(task1_id):
@@ -459,50 +1518,434 @@ def push(params, config):
     if not task_exists(task2_id):
         perror(f'Task {task2_id} does not exist!')
         return
+    parent_id = read_task(task1_id).get('parent')
+    if parent_id is None or read_task(task2_id).get('parent') != parent_id:
+        perror(f'Task {task1_id} is not a sibling of task {task2_id}!')
+        return
 
-    config['current']['tasks'].remove(task1_id)
-
-    dest = read_task(task2_id)
-    dest['tasks'].append(task1_id)
+    detach_subtask(parent_id, task1_id, config)
+    attach_subtask(task2_id, task1_id, config)
+    show_current(config)
 
-    write_task(current(config), config['current'])
-    write_task(task2_id, dest)
 
-    go_in([str(task2_id)], config, False)
-    start_state_propagation(config)
-    go_out(params, config, False)
-    see([], config)
+@command('mv', ['id', 'dest'], 'Moves task with id (from anywhere) under task with dest id')
+def move_task(params, config):
+    if len(params) != 2:
+        perror('Wrong number of parameters!')
+        return
+    if not are_params_ids(params):
+        perror('Params are not ids!')
+        return
+
+    task_id = int(params[0])
+    dest_id = int(params[1])
+
+    if task_id == 0:
+        perror('Cannot move root task!')
+        return
+    if not task_exists(task_id):
+        perror(f'Task {task_id} does not exist!')
+        return
+    if not task_exists(dest_id):
+        perror(f'Task {dest_id} does not exist!')
+        return
+    if task_id == dest_id or task_id in ancestors(dest_id):
+        perror(f'Cannot move task {task_id} into its own subtree!')
+        return
+
+    detach_subtask(read_task(task_id)['parent'], task_id, config)
+    attach_subtask(dest_id, task_id, config)
+    set_current(config, current(config))
+    show_current(config)
 
 
-@command('todo', None, f'Print first task todo ({TODO_STATE_SYMBOL} or {IN_PROGRESS_STATE_SYMBOL} state)')
+@command('todo', ['[N]', '[--tree]'], f'Print first N tasks todo ({TODO_STATE_SYMBOL} or {IN_PROGRESS_STATE_SYMBOL} state) by priority, due date or tree order')
 def todo(params, config):
-    todo_id = -1
-    id_history = [0]
-    history = [read_task(0)]
-    names_history = ['root']
-    while history:
-        task = history.pop()
-        if not task['tasks']:
-            if task['state'] != DONE_STATE:
-                todo_id = id_history[-1]
+    count = 1
+    for param in params:
+        if param.isnumeric() and int(param) > 0:
+            count = int(param)
+        elif param != '--tree':
+            perror(f'Wrong parameter {param}!')
+            return
+
+    if '--tree' in params:
+        todo_ids = [task_id for task_id, _, _ in itertools.islice(
+            sorted_leaves(0, [TODO_STATE, IN_PROGRESS_STATE]), count)]
+    else:
+        todo_ids = next_tasks(count)
+
+    if not todo_ids:
+        print(emojize('There is no task todo... :grinning_face:'))
+    for index, todo_id in enumerate(todo_ids):
+        if index:
+            print()
+        print_todo(todo_id, read_task(todo_id))
+
+
+def print_todo(task_id, task):
+    todo_path, id_path = task_paths(task_id)
+    print(todo_path)
+    print(f'ids path: {id_path}')
+    if 'priority' in task or 'due' in task:
+        print(f'priority: {task.get("priority", 0)}, due: {task.get("due", "-")}')
+    print_info(task, '---')
+
+
+def task_paths(task_id):
+    id_history = ancestors(task_id) + [task_id]
+    name_path = '/'.join(peek_task(history_id)['name'] for history_id in id_history)
+    id_path = ' '.join([str(id) for id in id_history])
+    return name_path, id_path
+
+
+MAX_DUE = '9999-12-31'
+
+
+INDEX_PAGE_SIZE = 64
+
+queued_tasks = {}
+
+
+class PagedIndex:
+    def __init__(self, name):
+        self.name = name
+        self.head = store.read_meta(name)
+        self.pages = {}
+        self.dirty = set()
+        if self.head is None:
+            self.head = {'root': 0, 'next': 1}
+            self.pages[0] = {'entries': []}
+            self.dirty.add(0)
+
+    def page(self, page_id):
+        if page_id not in self.pages:
+            self.pages[page_id] = store.read_meta(f'{self.name}-{page_id}')
+        return self.pages[page_id]
+
+    def new_page(self, page):
+        page_id = self.head['next']
+        self.head['next'] += 1
+        self.pages[page_id] = page
+        self.dirty.add(page_id)
+        return page_id
+
+    def drop_page(self, page_id):
+        self.pages[page_id] = None
+        self.dirty.add(page_id)
+
+    def descend(self, key):
+        path = []
+        page_id = self.head['root']
+        page = self.page(page_id)
+        while 'children' in page:
+            index = bisect.bisect_right(page['keys'], key)
+            path.append((page_id, index))
+            page_id = page['children'][index]
+            page = self.page(page_id)
+        return path, page_id, page
+
+    def insert(self, key):
+        path, page_id, page = self.descend(key)
+        entries = page['entries']
+        index = bisect.bisect_left(entries, key)
+        if index < len(entries) and entries[index] == key:
+            return
+        entries.insert(index, key)
+        self.dirty.add(page_id)
+        while len(page.get('entries', page.get('children'))) > INDEX_PAGE_SIZE:
+            if 'entries' in page:
+                half = len(page['entries']) // 2
+                right = {'entries': page['entries'][half:]}
+                separator = right['entries'][0]
+                del page['entries'][half:]
+            else:
+                half = len(page['children']) // 2
+                right = {'keys': page['keys'][half:], 'children': page['children'][half:]}
+                separator = page['keys'][half - 1]
+                del page['keys'][half - 1:], page['children'][half:]
+            right_id = self.new_page(right)
+            if not path:
+                self.head['root'] = self.new_page({'keys': [separator], 'children': [page_id, right_id]})
+                return
+            page_id, index = path.pop()
+            page = self.page(page_id)
+            page['keys'].insert(index, separator)
+            page['children'].insert(index + 1, right_id)
+            self.dirty.add(page_id)
+
+    def remove(self, key):
+        path, page_id, page = self.descend(key)
+        entries = page['entries']
+        index = bisect.bisect_left(entries, key)
+        if index == len(entries) or entries[index] != key:
+            return
+        del entries[index]
+        self.dirty.add(page_id)
+        while path and not page.get('entries', page.get('children')):
+            self.drop_page(page_id)
+            page_id, index = path.pop()
+            page = self.page(page_id)
+            del page['children'][index]
+            if page['keys']:
+                del page['keys'][max(index - 1, 0)]
+            self.dirty.add(page_id)
+        root = self.page(self.head['root'])
+        while len(root.get('children', ())) == 1:
+            self.drop_page(self.head['root'])
+            self.head['root'] = root['children'][0]
+            root = self.page(self.head['root'])
+
+    def iterate(self, low=None, page_id=None):
+        page = self.page(self.head['root'] if page_id is None else page_id)
+        if 'entries' in page:
+            start = 0 if low is None else bisect.bisect_left(page['entries'], low)
+            yield from page['entries'][start:]
+            return
+        start = 0 if low is None else bisect.bisect_right(page['keys'], low)
+        for child_id in page['children'][start:]:
+            yield from self.iterate(low, child_id)
+
+    def save(self):
+        for page_id in self.dirty:
+            if self.pages[page_id] is None:
+                store.remove_meta(f'{self.name}-{page_id}')
+            else:
+                store.write_meta(f'{self.name}-{page_id}', self.pages[page_id])
+        if self.dirty:
+            store.write_meta(self.name, self.head)
+        self.dirty.clear()
+
+
+def tree_slot(task):
+    return task.get('parent'), task.get('rank', 0)
+
+
+def tree_position(task):
+    position = []
+    while task.get('parent') is not None:
+        position.append(task.get('rank', 0))
+        task = peek_task(task['parent'])
+    position.reverse()
+    return position
+
+
+def queue_key(task_id, task):
+    return [-task.get('priority', 0), task.get('due', MAX_DUE), tree_position(task), task_id]
+
+
+def is_actionable(task):
+    return not task['tasks'] and task['state'] != DONE_STATE
+
+
+def queue_task(task_id):
+    queued_tasks[task_id] = None
+
+
+def queue_subtree(task_id):
+    stack = [task_id]
+    while stack:
+        task_id = stack.pop()
+        queue_task(task_id)
+        stack.extend(peek_task(task_id)['tasks'])
+
+
+def swap_ranks(first_id, second_id):
+    if first_id == second_id:
+        return
+    first, second = read_task(first_id), read_task(second_id)
+    first['rank'], second['rank'] = second.get('rank', 0), first.get('rank', 0)
+    write_task(first_id, first)
+    write_task(second_id, second)
+    queue_subtree(first_id)
+    queue_subtree(second_id)
+
+
+def is_queued(entry):
+    task_id = entry[-1]
+    if not task_exists(task_id):
+        return False
+    task = peek_task(task_id)
+    return is_actionable(task) and queue_key(task_id, task) == entry
+
+
+@on_commit
+def flush_queue():
+    if not queued_tasks:
+        return
+    queue = PagedIndex('todo_index')
+    keys = PagedIndex('todo_keys')
+    for task_id in sorted(queued_tasks):
+        entry = next(keys.iterate([task_id]), None)
+        old_key = entry[1] if entry is not None and entry[0] == task_id else None
+        new_key = None
+        if task_exists(task_id):
+            task = read_task(task_id)
+            if is_actionable(task):
+                new_key = queue_key(task_id, task)
+        if old_key != new_key:
+            if old_key is not None:
+                queue.remove(old_key)
+                keys.remove([task_id, old_key])
+            if new_key is not None:
+                queue.insert(new_key)
+                keys.insert([task_id, new_key])
+    queued_tasks.clear()
+    queue.save()
+    keys.save()
+
+
+def next_tasks(count):
+    flush_queue()
+    todo_ids = []
+    for entry in PagedIndex('todo_index').iterate():
+        if len(todo_ids) == count:
             break
-        for subtask_id in task['tasks']:
+        if is_queued(entry):
+            todo_ids.append(entry[-1])
+    return todo_ids
+
+
+@upgrade('tree_ranks')
+def upgrade_tree_ranks():
+    for task_id in get_all_tasks():
+        for rank, subtask_id in enumerate(read_task(task_id)['tasks']):
             subtask = read_task(subtask_id)
-            if subtask['state'] == TODO_STATE or subtask['state'] == IN_PROGRESS_STATE:
-                id_history.append(subtask_id)
-                history.append(subtask)
-                names_history.append(subtask['name'])
-                break
-    
-    if todo_id != -1:
-        todo_path = '/'.join([name for name in names_history])
-        id_path = ' '.join([str(id) for id in id_history])
-        todo_task = read_task(todo_id)
-        print(todo_path)
-        print(f'ids path: {id_path}')
-        print_info(todo_task, '---')
+            if subtask.get('rank') != rank:
+                subtask['rank'] = rank
+                write_task(subtask_id, subtask)
+
+
+@upgrade('todo_index')
+def upgrade_todo_index():
+    if store.read_meta('todo_queue') is not None:
+        store.remove_meta('todo_queue')
+    for task_id, _, task in sorted_leaves(0, [TODO_STATE, IN_PROGRESS_STATE]):
+        queue_task(task_id)
+
+
+@command('find', 'terms', 'Find tasks whose name or description contains all terms')
+def find(params, config):
+    terms = search_terms(' '.join(params))
+    if not terms:
+        perror('Missing terms parameter!')
+        return
+    flush_search_index()
+    postings = PagedIndex('search_postings')
+    found = None
+    for term in terms:
+        task_ids = {entry[1] for entry in itertools.takewhile(lambda entry: entry[0] == term, postings.iterate([term]))}
+        found = task_ids if found is None else found & task_ids
+        if not found:
+            break
+    if not found:
+        print('Nothing found.')
+        return
+    for task_id in sorted(found):
+        if not task_exists(task_id):
+            index_task(task_id)
+            continue
+        name_path, id_path = task_paths(task_id)
+        print(f'{name_path} (ids path: {id_path})')
+
+
+index_changes = {}
+
+
+def search_terms(text):
+    return set(re.findall(r'\w+', text.lower()))
+
+
+def task_terms(task):
+    return search_terms(task['name'] + ' ' + read_descr(task))
+
+
+def index_task(task_id):
+    index_changes[task_id] = None
+
+
+@on_commit
+def flush_search_index():
+    if not index_changes:
+        return
+    postings = PagedIndex('search_postings')
+    indexed = PagedIndex('search_terms')
+    for task_id in sorted(index_changes):
+        new_terms = task_terms(peek_task(task_id)) if task_exists(task_id) else set()
+        entries = itertools.takewhile(lambda entry: entry[0] == task_id, indexed.iterate([task_id]))
+        old_terms = {entry[1] for entry in entries}
+        for term in old_terms - new_terms:
+            postings.remove([term, task_id])
+            indexed.remove([task_id, term])
+        for term in new_terms - old_terms:
+            postings.insert([term, task_id])
+            indexed.insert([task_id, term])
+    index_changes.clear()
+    postings.save()
+    indexed.save()
+
+
+@upgrade('search_index')
+def upgrade_search_index():
+    for task_id in get_all_tasks():
+        index_task(task_id)
+
+
+@upgrade('search_pages')
+def upgrade_search_pages():
+    buckets = [name for name in store.meta_names() if re.fullmatch(r'search-[0-9a-f]{2}', name)]
+    for name in buckets:
+        store.remove_meta(name)
+    if buckets:
+        upgrade_search_index()
+
+
+@command('prio', ['id', 'priority'], 'Set task priority (higher first, 0 clears)')
+def set_priority(params, config):
+    if len(params) != 2:
+        perror('Missing id and priority parameters!')
+        return
+    error_msg = get_id_error_msg(params[:1], config)
+    if error_msg is not None:
+        perror(error_msg)
+        return
+    if not params[1].lstrip('-').isnumeric():
+        perror(f'Parameter {params[1]} is not an integer!')
+        return
+    task_id = id_from(params)
+    task = read_task(task_id)
+    if task['tasks']:
+        perror('Cannot set priority of task with subtasks!')
+        return
+    priority = int(params[1])
+    if priority == 0:
+        task.pop('priority', None)
+    else:
+        task['priority'] = priority
+    write_task(task_id, task)
+
+
+@command('due', ['id', '[date]'], 'Set task due date (YYYY-MM-DD, without date clears)')
+def set_due(params, config):
+    import datetime
+    error_msg = get_id_error_msg(params[:1], config)
+    if error_msg is not None:
+        perror(error_msg)
+        return
+    task_id = id_from(params)
+    task = read_task(task_id)
+    if task['tasks']:
+        perror('Cannot set due date of task with subtasks!')
+        return
+    if len(params) == 1:
+        task.pop('due', None)
     else:
-        print(emoji.emojize('There is no task todo... :grinning_face:'))
+        try:
+            task['due'] = datetime.date.fromisoformat(params[1]).isoformat()
+        except ValueError:
+            perror(f'Parameter {params[1]} is not a date!')
+            return
+    write_task(task_id, task)
 
 
 @command('edit', 'id', 'Edit task name')
@@ -520,13 +1963,14 @@ def edit(params, config):
     if not task_exists(task_id):
         perror(f'Task {task_id} does not exist!')
         return
-    if task_id not in config['current']['tasks']:
+    if not is_child_of_current(task_id, config):
         perror(f'Task {task_id} is not a child of current task!')
         return
     task = read_task(task_id)
     task['name'] = ' '.join(params[1:])
     write_task(task_id, task)
-    see([], config)
+    index_task(task_id)
+    show_current(config)
 
 
 @command('up', 'id', 'Move task up :up_arrow:')
@@ -536,13 +1980,20 @@ def move_up(params, config):
         perror(error_msg)
         return
     task_id = id_from(params)
+    if task_id == 0:
+        perror('Cannot move root task!')
+        return
 
-    curr_index = config['current']['tasks'].index(task_id)
+    parent_id = read_task(task_id)['parent']
+    parent = read_task(parent_id)
+    curr_index = parent['tasks'].index(task_id)
     new_index = max(0, curr_index - 1)
 
-    config['current']['tasks'][curr_index], config['current']['tasks'][new_index] = config['current']['tasks'][new_index], config['current']['tasks'][curr_index]
-    write_task(current(config), config['current'])
-    see([], config)
+    parent['tasks'][curr_index], parent['tasks'][new_index] = parent['tasks'][new_index], parent['tasks'][curr_index]
+    swap_ranks(parent['tasks'][curr_index], parent['tasks'][new_index])
+    write_task(parent_id, parent)
+    refresh_current(config)
+    show_current(config)
 
 
 @command('down', 'id', 'Move task down :down_arrow:')
@@ -552,36 +2003,221 @@ def move_down(params, config):
         perror(error_msg)
         return
     task_id = id_from(params)
+    if task_id == 0:
+        perror('Cannot move root task!')
+        return
 
-    curr_index = config['current']['tasks'].index(task_id)
-    new_index = min(len(config['current']['tasks']) - 1, curr_index + 1)
+    parent_id = read_task(task_id)['parent']
+    parent = read_task(parent_id)
+    curr_index = parent['tasks'].index(task_id)
+    new_index = min(len(parent['tasks']) - 1, curr_index + 1)
 
-    config['current']['tasks'][curr_index], config['current']['tasks'][new_index] = config['current']['tasks'][new_index], config['current']['tasks'][curr_index]
-    write_task(current(config), config['current'])
-    see([], config)
+    parent['tasks'][curr_index], parent['tasks'][new_index] = parent['tasks'][new_index], parent['tasks'][curr_index]
+    swap_ranks(parent['tasks'][curr_index], parent['tasks'][new_index])
+    write_task(parent_id, parent)
+    refresh_current(config)
+    show_current(config)
 
 
 @command('froot', ['[id1]', '[id2]', '[id3]', '...'], 'The same as `in` but you can specify whole path')
 def from_root(params, config):
-    init_config(config)
-    if are_params_ids(params):
-        for id in params:
-            task_id = int(id)
-            if task_id == 0:
-                continue
-            if not task_exists(task_id):
-                perror(f'Task {task_id} does not exist!')
-                return
-            if task_id not in config['current']['tasks']:
-                perror(f'Task {task_id} is not a child of current task!')
-                return
-            task = read_task(task_id)
-            config['current'] = task
-            config['history'].append(task_id)
-            config['name_history'].append(task['name'])
+    change_dir(['/' + '/'.join(param for param in params if param != '0')], config)
+
+
+@command('cd', '[path]', 'Go to task by path of names or ids, e.g. root/backend/auth or ../3')
+def change_dir(params, config):
+    resolved = resolve_path(' '.join(params), config) if params else ([0], config['name_history'][:1])
+    if isinstance(resolved, str):
+        perror(resolved)
+        return
+    config['history'], config['name_history'] = resolved
+    config['current'] = read_task(current(config))
+    show_current(config)
+
+
+def complete_line(line, begidx, config):
+    if ' ' not in line:
+        return [name + ' ' for name in sorted(commands) if name.startswith(line)]
+    cmd, rest = line.split(' ', 1)
+    if cmd == 'cd':
+        path, _, prefix = rest.rpartition('/')
+        if path or rest.startswith('/'):
+            resolved = resolve_path(path or '/', config)
+            if isinstance(resolved, str):
+                return []
+            parent_id = resolved[0][-1]
+        else:
+            parent_id = current(config)
+        head = len(prefix) - (len(line) - begidx)
+        matches = [name for name, _ in names_with_prefix(parent_id, prefix)]
+        if prefix.isnumeric():
+            matches += [str(child_id) for child_id in read_task(parent_id)['tasks'] if str(child_id).startswith(prefix)]
+        return [match[head:] + '/' for match in dict.fromkeys(matches)]
+    params = commands.get(cmd, {}).get('params', [])
+    if params[:1] not in (['id'], ['[id]'], ['id1']) or ' ' in rest:
+        return []
+    return [f'{child_id} ' for child_id in config['current']['tasks'] if str(child_id).startswith(rest)]
+
+
+def run_completion(line, begidx, config):
+    with transaction():
+        return complete_line(line, begidx, config)
+
+
+def setup_completion(complete):
+    import readline
+    matches = []
+
+    def completer(text, state):
+        if state == 0:
+            line = readline.get_line_buffer()[:readline.get_endidx()]
+            matches[:] = complete(line, readline.get_begidx())
+        return matches[state] if state < len(matches) else None
+
+    readline.set_completer_delims(' /')
+    readline.set_completer(completer)
+    if 'libedit' in (readline.__doc__ or ''):
+        readline.parse_and_bind('bind ^I rl_complete')
     else:
-        perror('Params are not ids!')
-    see([], config)
+        readline.parse_and_bind('tab: complete')
+
+
+@command('export', ['[id]', '[file]'], 'Exports task subtree as JSON Lines')
+def export_tasks(params, config):
+    task_id = current(config)
+    if params and params[0].isnumeric():
+        task_id = id_from(params)
+        params = params[1:]
+    if not task_exists(task_id):
+        perror(f'Task {task_id} does not exist!')
+        return
+    if params:
+        path = ' '.join(params)
+        try:
+            with open(path, 'w', encoding='utf-8') as file:
+                write_records(file, export_records(task_id))
+        except OSError as err:
+            raise CommandError(f'Cannot write {path}: {err.strerror}!')
+    else:
+        write_records(sys.stdout, export_records(task_id))
+
+
+def write_records(file, records):
+    for record in records:
+        file.write(json.dumps(record) + '\n')
+
+
+EXPORT_FIELDS = ['time_cost', 'worked_time', 'priority', 'due']
+
+
+def export_records(task_id):
+    stack = [iter([(0, task_id)])]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        order, task_id = entry
+        task = peek_task(task_id)
+        record = {
+            'id': task_id,
+            'parent': task.get('parent'),
+            'order': order,
+            'name': task['name'],
+            'state': task['state'],
+        }
+        for field in EXPORT_FIELDS:
+            if field in task:
+                record[field] = task[field]
+        describtion = read_descr(task)
+        if describtion:
+            record['descr'] = describtion
+        yield record
+        if task['tasks']:
+            stack.append(enumerate(list(task['tasks'])))
+
+
+@command('import', ['file', '[id]'], 'Imports JSON Lines task tree under current task or task with id')
+def import_tasks(params, config):
+    if not params:
+        perror('Missing file parameter!')
+        return
+    dest_id = current(config)
+    if len(params) > 1 and params[-1].isnumeric():
+        dest_id = int(params[-1])
+        params = params[:-1]
+    if not task_exists(dest_id):
+        perror(f'Task {dest_id} does not exist!')
+        return
+    path = ' '.join(params)
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            task_id = import_records(read_records(file))
+    except OSError as err:
+        raise CommandError(f'Cannot read {path}: {err.strerror}!')
+    except UnicodeDecodeError:
+        raise CommandError(f'{path} is not a UTF-8 text file!')
+    if task_id is None:
+        perror('Nothing to import!')
+        return
+    attach_subtask(dest_id, task_id, config)
+    show_current(config)
+
+
+def read_records(file):
+    for line_no, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise CommandError(f'Line {line_no} is not valid JSON!')
+        if not isinstance(record, dict) or 'id' not in record or 'name' not in record:
+            raise CommandError(f'Line {line_no} is not a task record with id and name!')
+        yield record
+
+
+def import_records(records):
+    stack = []
+    root_id = None
+    for record in records:
+        while stack and stack[-1]['old_id'] != record.get('parent'):
+            finish_import_frame(stack)
+        if not stack and root_id is not None:
+            raise CommandError(f'Task {record["id"]} is not part of the imported tree!')
+        task = empty_task(record['name'])
+        task['state'] = record.get('state') if record.get('state') in STATE_COUNT_FIELDS else TODO_STATE
+        for field in EXPORT_FIELDS:
+            if field in record:
+                task[field] = record[field]
+        set_descr(task, record.get('descr'))
+        task_id = available_id()
+        if stack:
+            task['parent'] = stack[-1]['id']
+        else:
+            root_id = task_id
+        stack.append({'old_id': record['id'], 'id': task_id, 'task': task,
+                      'values': [0] * len(ROLLUP_FIELDS)})
+    while stack:
+        finish_import_frame(stack)
+    return root_id
+
+
+def finish_import_frame(stack):
+    frame = stack.pop()
+    task = frame['task']
+    if task['tasks']:
+        set_rollup(task, frame['values'])
+        task['state'] = derived_state(task)
+    if stack:
+        task['rank'] = len(stack[-1]['task']['tasks'])
+    write_task(frame['id'], task)
+    index_task(frame['id'])
+    if stack:
+        parent = stack[-1]
+        parent['task']['tasks'].append(frame['id'])
+        count_state(parent['task'], task['state'], 1)
+        parent['values'] = add_rollups(parent['values'], rollup(task))
 
 
 def is_float(str):
@@ -605,11 +2241,13 @@ def eval_cost(params, config):
             perror(f'Parameter {params[0]} is not a floating point number!')
             return
         cost = float(params[0])
+        old = summary(config['current'])
         if cost == 0:
             config['current'].pop('time_cost', None)
         else:
             config['current']['time_cost'] = cost
         write_task(current(config), config['current'])
+        update_ancestors(config['current'].get('parent'), old, summary(config['current']), config)
     elif len(params) == 2:
         if not params[0].isnumeric():
             perror(f'Parameter {params[0]} is not an id!')
@@ -618,62 +2256,242 @@ def eval_cost(params, config):
         if not task_exists(task_id):
             perror(f'Task {task_id} does not exist!')
             return
-        if task_id not in config['current']['tasks']:
+        if not is_child_of_current(task_id, config):
             perror(f'Task {task_id} is not a child of current task!')
             return
         if not is_float(params[1]):
             perror(f'Parameter {params[1]} is not a floating point number!')
             return
         task = read_task(task_id)
+        old = summary(task)
         cost = float(params[1])
         if cost == 0:
             task.pop('time_cost', None)
         else:
             task['time_cost'] = cost
         write_task(task_id, task)
+        update_ancestors(task.get('parent'), old, summary(task), config)
     else:
         perror('Wrong number of parameters!')
         return
 
 
-@command('cost', '[id]', 'Lets you see cumulative cost of a task')
+@command('cost', ['[id]', '[--verify]'], 'Lets you see cumulative cost of a task')
 def see_cost(params, config):
+    task_id = rollup_task_id(params, config)
+    if task_id is None:
+        return
+    if '--verify' in params:
+        verify_subtree_rollups(task_id, config)
+    print('Time cost:', sum_cost(read_task(task_id)))
+
+
+def rollup_task_id(params, config):
+    params = [param for param in params if param != '--verify']
     if not params:
-        task = config['current']
+        return current(config)
+    error_msg = get_id_error_msg(params, config)
+    if error_msg is not None:
+        perror(error_msg)
+        return None
+    return id_from(params)
+
+
+def sum_cost(task):
+    return rollup(task)[0]
+
+
+ROLLUP_FIELDS = ['cum_time_cost', 'cum_worked_time', 'leaf_count', 'timer_count', 'timer_start_sum']
+
+
+def rollup(task):
+    import datetime
+    if task['tasks']:
+        return [task.get(field, 0) for field in ROLLUP_FIELDS]
+    timer_count, timer_start = 0, 0
+    if 'work_time_start' in task:
+        timer_count = 1
+        timer_start = datetime.datetime.fromisoformat(task['work_time_start']).timestamp()
+    return [task.get('time_cost', 0), task.get('worked_time', 0), 1, timer_count, timer_start]
+
+
+def set_rollup(task, values):
+    if task['tasks']:
+        task.update(zip(ROLLUP_FIELDS, values))
+        if not task['timer_count']:
+            task['timer_start_sum'] = 0
     else:
-        error_msg = get_id_error_msg(params, config)
-        if error_msg is not None:
-            perror(error_msg)
-            return
-        task_id = id_from(params)
+        for field in ROLLUP_FIELDS:
+            task.pop(field, None)
+
+
+def add_rollups(values, other, sign=1):
+    return [value + sign * other_value for value, other_value in zip(values, other)]
+
+
+def rollups_equal(values, other):
+    return all(math.isclose(value, other_value, rel_tol=1e-9, abs_tol=1e-6)
+               for value, other_value in zip(values, other))
+
+
+def summary(task):
+    return task['state'], rollup(task)
+
+
+def update_ancestors(task_id, old, new, config):
+    old_state, new_state = old[0], new[0]
+    delta = add_rollups(new[1], old[1], -1)
+    while task_id is not None:
+        if old_state == new_state and not any(delta):
+            break
         task = read_task(task_id)
-    print('Time cost:', sum_cost(task))
+        if any(delta):
+            set_rollup(task, add_rollups(rollup(task), delta))
+        if old_state != new_state:
+            count_state(task, old_state, -1)
+            count_state(task, new_state, 1)
+            old_state, new_state = task['state'], derived_state(task)
+            task['state'] = new_state
+        write_task(task_id, task)
+        task_id = task.get('parent')
+    refresh_current(config)
 
 
-def sum_cost(task):
-    sum = 0
-    if 'time_cost' in task and not task['tasks']:
-        sum = task['time_cost']
-    for subtask_id in task['tasks']:
-        subtask = read_task(subtask_id)
-        sum += sum_cost(subtask)
-    return sum
+def attach_subtask(parent_id, subtask_id, config):
+    parent = read_task(parent_id)
+    old = summary(parent)
+    subtask = read_task(subtask_id)
+    subtask['parent'] = parent_id
+    subtask['rank'] = read_task(parent['tasks'][-1]).get('rank', 0) + 1 if parent['tasks'] else 0
+    write_task(subtask_id, subtask)
+    if subtask['tasks']:
+        queue_subtree(subtask_id)
+    subtask_state, values = summary(subtask)
+    if parent['tasks']:
+        values = add_rollups(old[1], values)
+    if parent['tasks']:
+        parent['tasks'].append(subtask_id)
+    else:
+        parent['tasks'] = [subtask_id]
+    set_rollup(parent, values)
+    count_state(parent, subtask_state, 1)
+    parent['state'] = derived_state(parent)
+    write_task(parent_id, parent)
+    update_ancestors(parent.get('parent'), old, summary(parent), config)
 
 
-@command('sort', None, 'Prints tasks sorted in order in the tree')
-def sort_tasks(params, config, task_id = 0, history = []):
+def detach_subtask(parent_id, subtask_id, config):
+    parent = read_task(parent_id)
+    old = summary(parent)
+    subtask_state, values = summary(read_task(subtask_id))
+    parent['tasks'].remove(subtask_id)
+    set_rollup(parent, add_rollups(old[1], values, -1))
+    count_state(parent, subtask_state, -1)
+    if not parent['tasks']:
+        clear_state_counts(parent)
+    parent['state'] = derived_state(parent)
+    write_task(parent_id, parent)
+    update_ancestors(parent.get('parent'), old, summary(parent), config)
+
+
+def verify_rollups(task_id, drifted, timers=None):
     task = read_task(task_id)
-    if not task['tasks'] and task['state'] in [TODO_STATE, IN_PROGRESS_STATE]:
-        tmp = task['name']
-        task['name'] = '/'.join(history) + f'/{tmp}'
-        print_task(task_id, task)
-        task['name'] = tmp
+    if not task['tasks']:
+        if timers is not None and 'work_time_start' in task:
+            timers[str(task_id)] = {'start': task['work_time_start']}
+        return rollup(task)
+    values = [0] * len(ROLLUP_FIELDS)
     for subtask_id in task['tasks']:
-        sort_tasks(params, config, subtask_id, history + [task['name']])
+        values = add_rollups(values, verify_rollups(subtask_id, drifted, timers))
+    if not rollups_equal(rollup(task), values):
+        drifted.append(task_id)
+        set_rollup(task, values)
+        write_task(task_id, task)
+    return values
+
+
+def verify_subtree_rollups(task_id, config):
+    task = read_task(task_id)
+    old = summary(task)
+    drifted = []
+    new = verify_rollups(task_id, drifted)
+    update_ancestors(task.get('parent'), old, (old[0], new), config)
+    if drifted:
+        print(f'Fixed rollup drift in {len(drifted)} tasks:', ' '.join(f'#{task_id}' for task_id in drifted))
+    else:
+        print('Rollups are up to date.')
+
+
+@upgrade('rollups')
+def upgrade_rollups():
+    timers = {}
+    verify_rollups(0, [], timers)
+    store.write_meta('timers', timers)
+
+
+SORT_CHUNK_SIZE = 256
+
+
+@command('sort', ['[id]', '[--limit N]', '[--state state,...]'], 'Prints tasks sorted in order in the tree')
+def sort_tasks(params, config):
+    task_id = 0
+    limit = None
+    states = [TODO_STATE, IN_PROGRESS_STATE]
+    params = list(params)
+    while params:
+        param = params.pop(0)
+        if param == '--limit' and params and params[0].isnumeric():
+            limit = int(params.pop(0))
+        elif param == '--state' and params:
+            states = params.pop(0).split(',')
+            for state in states:
+                if state not in STATE_COUNT_FIELDS:
+                    perror(f'Unknown state {state}!')
+                    return
+        elif param.isnumeric():
+            task_id = int(param)
+        else:
+            perror(f'Wrong parameter {param}!')
+            return
+    if not task_exists(task_id):
+        perror(f'Task {task_id} does not exist!')
+        return
+    if limit == 0:
+        return
+
+    lines = []
+    for count, (leaf_id, path, task) in enumerate(sorted_leaves(task_id, states), 1):
+        lines.append(format_task(leaf_id, task, path) + '\n')
+        if len(lines) == SORT_CHUNK_SIZE:
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+            lines.clear()
+        if count == limit:
+            break
+    sys.stdout.write(''.join(lines))
+
+
+def sorted_leaves(task_id, states):
+    prefix = '/'.join(peek_task(ancestor_id)['name'] for ancestor_id in ancestors(task_id))
+    stack = [(prefix, iter([task_id]))]
+    while stack:
+        prefix, subtask_ids = stack[-1]
+        subtask_id = next(subtask_ids, None)
+        if subtask_id is None:
+            stack.pop()
+            continue
+        task = peek_task(subtask_id)
+        path = f'{prefix}/{task["name"]}' if prefix else task['name']
+        if not task['tasks']:
+            if task['state'] in states:
+                yield subtask_id, path, task
+        elif task['state'] in states or task['state'] == IN_PROGRESS_STATE:
+            stack.append((path, iter(task['tasks'])))
 
 
 @command('bwork', 'id', 'Begins to record working time')
 def begin_work(params, config):
+    import datetime
     error_msg = get_id_error_msg(params, config)
     if error_msg is not None:
         perror(error_msg)
@@ -683,8 +2501,13 @@ def begin_work(params, config):
     if task['tasks']:
         perror('Cannot to begin recording working time on task that has subtasks!')
         return
+    old = summary(task)
     task['work_time_start'] = datetime.datetime.now().isoformat()
     write_task(task_id, task)
+    update_ancestors(task.get('parent'), old, summary(task), config)
+    timers = read_timers()
+    timers[str(task_id)] = {'start': task['work_time_start'], 'owner': config.get('owner', os.getpid())}
+    store.write_meta('timers', timers)
 
 
 @command('ework', 'id', 'Ends recording working time')
@@ -698,8 +2521,12 @@ def end_work(params, config):
     if task['tasks']:
         perror('Cannot to end recording working time on task that has subtasks!')
         return
+    old = summary(task)
+    log_work(task_id, task)
     end_work_task(task)
     write_task(task_id, task)
+    update_ancestors(task.get('parent'), old, summary(task), config)
+    forget_timers([task_id])
 
 
 def end_work_task(task):
@@ -708,6 +2535,7 @@ def end_work_task(task):
 
 
 def get_last_work_time(task):
+    import datetime
     now = datetime.datetime.now()
     if 'work_time_start' in task:
         then = datetime.datetime.fromisoformat(task['work_time_start'])
@@ -715,30 +2543,69 @@ def get_last_work_time(task):
     return 0
 
 
-def end_work_in_all_tasks():
-    for task_id in get_all_tasks():
-        task = read_task(task_id)
-        if not task['tasks']:
+def read_timers():
+    return store.read_meta('timers', {})
+
+
+def forget_timers(task_ids):
+    timers = read_timers()
+    running = len(timers)
+    for task_id in task_ids:
+        timers.pop(str(task_id), None)
+    if len(timers) != running:
+        store.write_meta('timers', timers)
+
+
+def end_work_in_all_tasks(owner=None):
+    with transaction():
+        end_running_timers(os.getpid() if owner is None else owner)
+
+
+def owner_alive(owner):
+    pid = str(owner).split('-')[0]
+    return not pid.isdigit() or pid_alive(int(pid))
+
+
+def end_running_timers(owner=None):
+    timers = read_timers()
+    config = {}
+    ended = [task_id for task_id, timer in timers.items()
+             if owner is None or timer.get('owner', owner) == owner
+             or not owner_alive(timer.get('owner', owner))]
+    for task_id in ended:
+        del timers[task_id]
+        task_id = int(task_id)
+        if task_exists(task_id):
+            task = read_task(task_id)
+            old = summary(task)
+            log_work(task_id, task)
             end_work_task(task)
             write_task(task_id, task)
+            update_ancestors(task.get('parent'), old, summary(task), config)
+    if ended:
+        store.write_meta('timers', timers)
+
+
+@command('timers', None, 'List running work timers')
+def list_timers(params, config):
+    timers = read_timers()
+    if not timers:
+        print('No timers are running.')
+        return
+    for task_id, timer in timers.items():
+        task = read_task(int(task_id))
+        elapsed = get_last_work_time({'work_time_start': timer['start']})
+        print(f'#{task_id} {strftime(elapsed)} {task["name"]}')
 
 
-@command('wtime', '[id]', 'See time spent in working on task')
+@command('wtime', ['[id]', '[--verify]'], 'See time spent in working on task')
 def working_time(params, config):
-    if params:
-        error_msg = get_id_error_msg(params, config)
-        if error_msg is not None:
-            perror(error_msg)
-            return
-        task_id = id_from(params)
-        task = read_task(task_id)
-    else:
-        task_id = current(config)
-        task = config['current']
-    if not task['tasks']:
-        working_time_val = task.get('worked_time', 0) + get_last_work_time(task)
-    else:
-        working_time_val = sum_working_time(task_id)
+    task_id = rollup_task_id(params, config)
+    if task_id is None:
+        return
+    if '--verify' in params:
+        verify_subtree_rollups(task_id, config)
+    working_time_val = sum_working_time(read_task(task_id))
     formatted_time = strftime(working_time_val) #time.strftime('%H:%M:%S', time.gmtime(working_time_val))
     print(f'Time spent working: {formatted_time}')
 
@@ -751,16 +2618,10 @@ def strftime(time_val):
     return f'{hours}:{minutes}:{seconds}'
 
 
-def sum_working_time(task_id):
-    task = read_task(task_id)
-
-    sum = 0
-    if task['tasks']:
-        for subtask_id in task['tasks']:
-            sum += sum_working_time(subtask_id)
-        return sum
-    else:
-        return task.get('worked_time', 0) + get_last_work_time(task)
+def sum_working_time(task):
+    import datetime
+    _, worked_time, _, timer_count, timer_start_sum = rollup(task)
+    return worked_time + timer_count * datetime.datetime.now().timestamp() - timer_start_sum
 
 
 @command('wreset', 'id', 'Reset worked time in task')
@@ -774,15 +2635,869 @@ def work_time_reset(params, config):
     if task['tasks']:
         perror('Cannot to worked time on task that has subtasks!')
         return
+    old = summary(task)
     task.pop('worked_time', None)
     write_task(task_id, task)
+    update_ancestors(task.get('parent'), old, summary(task), config)
+
+
+WORKLOG_RECORD = struct.Struct('<Idd')
+WORKLOG_CHUNK_RECORDS = 4096
+WORKLOG_CHECKPOINT_RECORDS = 4096
+REMOVED_BRANCH = -1
+
+logged_work = []
+
+
+def log_work(task_id, task):
+    import datetime
+    if 'work_time_start' in task:
+        start = datetime.datetime.fromisoformat(task['work_time_start']).timestamp()
+        logged_work.append(WORKLOG_RECORD.pack(task_id, start, time.time()))
+
+
+@on_commit
+def flush_worklog():
+    if not logged_work:
+        return
+    add_logged_ids(WORKLOG_RECORD.unpack(record)[0] for record in logged_work)
+    with open(WORKLOG_PATH, 'ab') as log:
+        size = log.tell()
+        if size % WORKLOG_RECORD.size:
+            log.truncate(size - size % WORKLOG_RECORD.size)
+        log.write(b''.join(logged_work))
+        size = log.tell()
+    logged_work.clear()
+    checkpoint = read_checkpoint()
+    if size - checkpoint['offset'] >= WORKLOG_CHECKPOINT_RECORDS * WORKLOG_RECORD.size:
+        add_work_days(checkpoint['days'], read_worklog(checkpoint['offset']))
+        checkpoint['offset'] = size
+        store.write_meta('worklog', checkpoint)
+
+
+def add_logged_ids(task_ids):
+    index = PagedIndex('logged_ids')
+    for task_id in sorted(set(task_ids)):
+        if next(index.iterate([task_id]), None) != [task_id]:
+            index.insert([task_id])
+    index.save()
+
+
+def work_logged(task_id):
+    if any(WORKLOG_RECORD.unpack(record)[0] == task_id for record in logged_work):
+        return True
+    return next(PagedIndex('logged_ids').iterate([task_id]), None) == [task_id]
+
+
+@upgrade('logged_ids')
+def upgrade_logged_ids():
+    checkpoint = read_checkpoint()
+    task_ids = {int(task_id) for totals in checkpoint['days'].values() for task_id in totals}
+    task_ids.update(task_id for task_id, start, end in read_worklog())
+    add_logged_ids(task_ids)
+
+
+def read_checkpoint():
+    return store.read_meta('worklog', {'offset': 0, 'days': {}})
+
+
+def read_worklog(offset=0):
+    try:
+        log = open(WORKLOG_PATH, 'rb')
+    except FileNotFoundError:
+        return
+    with log:
+        log.seek(offset)
+        while True:
+            chunk = log.read(WORKLOG_RECORD.size * WORKLOG_CHUNK_RECORDS)
+            chunk = chunk[:len(chunk) - len(chunk) % WORKLOG_RECORD.size]
+            if not chunk:
+                break
+            yield from WORKLOG_RECORD.iter_unpack(chunk)
+
+
+def add_work_days(days, intervals):
+    import datetime
+    for task_id, start, end in intervals:
+        sign = 1
+        if end < start:
+            start, end, sign = end, start, -1
+        while start < end:
+            day = datetime.date.fromtimestamp(start)
+            next_day = datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time()).timestamp()
+            day_end = min(end, next_day)
+            totals = days.setdefault(day.isoformat(), {})
+            seconds = totals.get(str(task_id), 0) + sign * (day_end - start)
+            if abs(seconds) < 1e-6:
+                totals.pop(str(task_id), None)
+            else:
+                totals[str(task_id)] = seconds
+            start = day_end
+
+
+def running_intervals():
+    import datetime
+    now = time.time()
+    for task_id, timer in read_timers().items():
+        yield int(task_id), datetime.datetime.fromisoformat(timer['start']).timestamp(), now
+
+
+def work_branch(task_id, root_id, branches):
+    path = []
+    branch = None
+    while task_id not in branches:
+        path.append(task_id)
+        if task_id == root_id:
+            branch = root_id
+            break
+        if not task_exists(task_id):
+            branch = REMOVED_BRANCH if root_id == 0 else None
+            break
+        parent_id = read_task(task_id).get('parent')
+        if parent_id == root_id:
+            branch = task_id
+            break
+        if parent_id is None:
+            break
+        task_id = parent_id
+    else:
+        branch = branches[task_id]
+    for path_id in path:
+        branches[path_id] = branch
+    return branch
+
+
+@command('report', ['[from]', '[to]', '[id]'], 'Prints worked time per day and subtask from the work log')
+def work_report(params, config):
+    import datetime
+    task_id = 0
+    dates = []
+    for param in params:
+        if param.isnumeric():
+            task_id = int(param)
+            continue
+        try:
+            dates.append(datetime.date.fromisoformat(param).isoformat())
+        except ValueError:
+            perror(f'Parameter {param} is not a date (YYYY-MM-DD) or an id!')
+            return
+    if len(dates) > 2:
+        perror('Too many dates!')
+        return
+    if not task_exists(task_id):
+        perror(f'Task {task_id} does not exist!')
+        return
+    first = dates[0] if dates else ''
+    last = dates[1] if len(dates) > 1 else '9999-12-31'
+
+    checkpoint = read_checkpoint()
+    days = checkpoint['days']
+    add_work_days(days, read_worklog(checkpoint['offset']))
+    add_work_days(days, running_intervals())
+
+    branches = {}
+    day_totals = {}
+    branch_totals = {}
+    for day in sorted(days):
+        if not first <= day <= last:
+            continue
+        for logged_id, seconds in days[day].items():
+            branch = work_branch(int(logged_id), task_id, branches)
+            if branch is None:
+                continue
+            day_totals[day] = day_totals.get(day, 0) + seconds
+            branch_totals[branch] = branch_totals.get(branch, 0) + seconds
+
+    if not day_totals:
+        print('No work logged.')
+        return
+    lines = [f'{day} {strftime(seconds)}' for day, seconds in day_totals.items()]
+    lines.append(f'Total: {strftime(sum(day_totals.values()))}')
+    for branch, seconds in sorted(branch_totals.items(), key=lambda item: -item[1]):
+        if branch == REMOVED_BRANCH:
+            lines.append(f'{strftime(seconds)} (removed tasks)')
+        else:
+            lines.append(f'{strftime(seconds)} #{branch} {read_task(branch)["name"]}')
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+
+STATE_CODES = {TODO_STATE: 0, IN_PROGRESS_STATE: 1, DONE_STATE: 2}
+ANALYZE_COLUMNS = ['time_cost', 'worked_time', 'leaves', 'done_leaves']
+
+
+def subtree_columns(task_id):
+    import datetime
+    now = time.time()
+    columns = {name: [] for name in ['id', 'parent', 'depth', 'state', 'leaf', 'time_cost', 'worked_time', 'name']}
+    stack = [(task_id, -1, 0)]
+    while stack:
+        node_id, parent_index, depth = stack.pop()
+        task = peek_task(node_id)
+        index = len(columns['id'])
+        leaf = not task['tasks']
+        worked_time = task.get('worked_time', 0) if leaf else 0
+        if leaf and 'work_time_start' in task:
+            worked_time += now - datetime.datetime.fromisoformat(task['work_time_start']).timestamp()
+        columns['id'].append(node_id)
+        columns['parent'].append(parent_index)
+        columns['depth'].append(depth)
+        columns['state'].append(STATE_CODES[task['state']])
+        columns['leaf'].append(leaf)
+        columns['time_cost'].append(task.get('time_cost', 0) if leaf else 0)
+        columns['worked_time'].append(worked_time)
+        columns['name'].append(task['name'])
+        stack.extend((subtask_id, index, depth + 1) for subtask_id in reversed(task['tasks']))
+    return columns
+
+
+def subtree_totals(np, columns):
+    parent = np.array(columns['parent'], dtype=np.int64)
+    depth = np.array(columns['depth'], dtype=np.int64)
+    state = np.array(columns['state'], dtype=np.int8)
+    leaf = np.array(columns['leaf'], dtype=bool)
+    totals = np.zeros((len(parent), len(ANALYZE_COLUMNS)))
+    totals[:, 0] = columns['time_cost']
+    totals[:, 1] = columns['worked_time']
+    totals[:, 2] = leaf
+    totals[:, 3] = leaf & (state == STATE_CODES[DONE_STATE])
+    order = np.argsort(depth, kind='stable')
+    bounds = np.searchsorted(depth[order], np.arange(depth.max() + 2))
+    for level in range(depth.max(), 0, -1):
+        nodes = order[bounds[level]:bounds[level + 1]]
+        np.add.at(totals, parent[nodes], totals[nodes])
+    return parent, depth, state, leaf, totals
+
+
+@command('analyze', ['[id]', '[--csv]'], 'Prints estimated cost, worked time and completion of a subtree')
+def analyze(params, config):
+    try:
+        import numpy as np
+    except ImportError:
+        perror('analyze needs numpy! Try: pip install numpy')
+        return
+    as_csv = '--csv' in params
+    params = [param for param in params if param != '--csv']
+    task_id = current(config)
+    if params:
+        if is_task_id(params):
+            task_id = id_from(params)
+        else:
+            perror('Id parameter is wrong!')
+            return
+    if not task_exists(task_id):
+        perror(f'Task {task_id} does not exist!')
+        return
+
+    columns = subtree_columns(task_id)
+    parent, depth, state, leaf, totals = subtree_totals(np, columns)
+    if as_csv:
+        write_analysis_csv(columns, totals)
+        return
+
+    lines = [f'{"task":<32} {"leaves":>8} {"done":>6} {"cost":>10} {"worked":>10}']
+    for index in [0] + np.nonzero(parent == 0)[0].tolist():
+        time_cost, worked_time, leaves, done_leaves = totals[index]
+        name = 'Total' if index == 0 else f'#{columns["id"][index]} {columns["name"][index]}'
+        lines.append(f'{name[:32]:<32} {int(leaves):>8} {done_leaves / max(leaves, 1):>6.0%} '
+                     f'{time_cost:>10g} {strftime(worked_time):>10}')
+
+    names = [STATE_SYMBOLS[state_name] for state_name in STATE_CODES]
+    leaf_states = np.bincount(state[leaf], minlength=len(STATE_CODES))
+    lines.append('\nLeaves per state: ' + ', '.join(f'{name} {count}' for name, count in zip(names, leaf_states)))
+
+    nodes_per_depth = np.bincount(depth)
+    done_per_depth = np.bincount(depth, weights=state == STATE_CODES[DONE_STATE])
+    lines.append('Completion by depth:')
+    for level in range(1, len(nodes_per_depth)):
+        lines.append(f'  {level:>3} {done_per_depth[level] / nodes_per_depth[level]:>6.0%} of {nodes_per_depth[level]}')
+    sys.stdout.write(emojize('\n'.join(lines)) + '\n')
+
+
+def write_analysis_csv(columns, totals):
+    import csv
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['id', 'parent', 'depth', 'state', 'name'] + ANALYZE_COLUMNS)
+    states = list(STATE_CODES)
+    for index, task_id in enumerate(columns['id']):
+        parent_index = columns['parent'][index]
+        writer.writerow([task_id, columns['id'][parent_index] if parent_index >= 0 else '',
+                         columns['depth'][index], states[columns['state'][index]], columns['name'][index]]
+                        + [f'{value:g}' for value in totals[index]])
+
+
+UNDO_META = ['ids', 'timers']
+
+
+def is_undo_meta(name):
+    return name.partition('-')[0] in UNDO_META
+
+
+@contextmanager
+def undo_step(cmd, params):
+    if UNDO_DEPTH <= 0 or cmd in ('undo', 'redo') or store.recording is not None:
+        yield
+        return
+    work_mark = len(logged_work)
+    store.start_recording()
+    try:
+        yield
+    finally:
+        recording = store.stop_recording()
+    drop_unchanged(recording)
+    recording['work'] = [list(WORKLOG_RECORD.unpack(record)) for record in logged_work[work_mark:]]
+    if recording['tasks'] or recording['meta'] or recording['work']:
+        recording['command'] = ' '.join([cmd] + params)
+        push_undo_step(recording)
+
+
+def drop_unchanged(recording):
+    recording['digests'] = {}
+    for task_id, before in list(recording['tasks'].items()):
+        digest = stored_task_digest(int(task_id))
+        if task_digest(before) == digest:
+            del recording['tasks'][task_id]
+        else:
+            recording['digests'][task_id] = digest
+    for name, before in list(recording['meta'].items()):
+        after = store.read_meta(name)
+        if before == after:
+            del recording['meta'][name]
+        else:
+            recording['meta'][name] = meta_delta(before, after)
+
+
+def meta_delta(before, after):
+    if not isinstance(before, dict) or not isinstance(after, dict):
+        return {'value': before}
+    keys = sorted(key for key in before.keys() | after.keys()
+                  if key not in before or key not in after or before[key] != after[key])
+    return {'keys': {key: [before[key]] if key in before else [] for key in keys}}
+
+
+def apply_meta_delta(name, delta):
+    current = store.read_meta(name)
+    if 'value' in delta:
+        if delta['value'] is None:
+            store.remove_meta(name)
+        else:
+            store.write_meta(name, delta['value'])
+        return {'value': current}
+    if current is None:
+        current = {}
+    reverse = {'keys': {key: [current[key]] if key in current else [] for key in delta['keys']}}
+    for key, before in delta['keys'].items():
+        if before:
+            current[key] = before[0]
+        else:
+            current.pop(key, None)
+    store.write_meta(name, current)
+    return reverse
+
+
+@upgrade('undo_meta_deltas')
+def upgrade_undo_meta_deltas():
+    history = store.read_meta('undo')
+    if history is None:
+        return
+    for step_id in history['undo'] + history['redo']:
+        step = store.read_meta(f'undo-{step_id}')
+        step['meta'] = {name: {'value': value} for name, value in step['meta'].items()}
+        store.write_meta(f'undo-{step_id}', step)
+
+
+def read_undo_history():
+    return store.read_meta('undo', {'next': 0, 'undo': [], 'redo': []})
+
+
+def push_undo_step(step):
+    history = read_undo_history()
+    for step_id in history['redo']:
+        drop_undo_step(step_id)
+    history['redo'] = []
+    store.write_meta(f'undo-{history["next"]}', step)
+    count_step_blobs(step, 1)
+    history['undo'].append(history['next'])
+    history['next'] += 1
+    while len(history['undo']) > UNDO_DEPTH:
+        drop_undo_step(history['undo'].pop(0))
+    store.write_meta('undo', history)
+
+
+def drop_undo_step(step_id):
+    name = f'undo-{step_id}'
+    count_step_blobs(store.read_meta(name), -1)
+    store.remove_meta(name)
+
+
+def task_digest(data):
+    if data is None:
+        return None
+    data = {key: value for key, value in data.items() if key != 'version'}
+    return zlib.crc32(json.dumps(data, sort_keys=True).encode('utf-8'))
+
+
+def stored_task_digest(task_id):
+    return task_digest(read_task(task_id).to_dict()) if task_exists(task_id) else None
+
+
+def apply_undo_step(step):
+    for task_id, digest in step['digests'].items():
+        if stored_task_digest(int(task_id)) != digest:
+            raise CommandError(f'Task {task_id} was changed after `{step["command"]}`! Cannot revert it.')
+    reverse = {'command': step['command'], 'tasks': {}, 'meta': {}, 'digests': {}, 'work': []}
+    for task_id, start, end in step.get('work', []):
+        logged_work.append(WORKLOG_RECORD.pack(task_id, end, start))
+        reverse['work'].append([task_id, end, start])
+    moved = []
+    for name, delta in step['meta'].items():
+        reverse['meta'][name] = apply_meta_delta(name, delta)
+    for task_id, data in step['tasks'].items():
+        task_id = int(task_id)
+        current_task = read_task(task_id) if task_exists(task_id) else None
+        reverse['tasks'][str(task_id)] = current_task.to_dict() if current_task is not None else None
+        if data is None:
+            if current_task is not None:
+                remove_task(task_id)
+            index_task(task_id)
+            reverse['digests'][str(task_id)] = None
+            continue
+        task = Task(data)
+        task['version'] = current_task.get('version', 0) if current_task is not None else 0
+        write_task(task_id, task)
+        index_task(task_id)
+        reverse['digests'][str(task_id)] = task_digest(task.to_dict())
+        if current_task is not None and tree_slot(current_task) != tree_slot(task):
+            moved.append(task_id)
+    for task_id in moved:
+        queue_subtree(task_id)
+    return reverse
+
+
+def move_undo_step(source, target, config):
+    history = read_undo_history()
+    if not history[source]:
+        perror(f'Nothing to {source}!')
+        return
+    step_id = history[source].pop()
+    name = f'undo-{step_id}'
+    step = store.read_meta(name)
+    reverse = apply_undo_step(step)
+    store.write_meta(name, reverse)
+    count_step_blobs(step, -1)
+    count_step_blobs(reverse, 1)
+    history[target].append(step_id)
+    store.write_meta('undo', history)
+    if 'current' in config:
+        refresh_stale_current(config)
+    print(f'{source.capitalize()}: {reverse["command"]}')
+    show_current(config)
+
+
+@command('undo', None, 'Reverts the last command that changed tasks')
+def undo(params, config):
+    move_undo_step('undo', 'redo', config)
+
+
+@command('redo', None, 'Repeats the last undone command')
+def redo(params, config):
+    move_undo_step('redo', 'undo', config)
+
+
+STATS_OPERATIONS = ['read', 'peek', 'write', 'exists', 'stamp', 'remove', 'ids', 'read_meta', 'write_meta', 'remove_meta',
+                    'meta_names', 'commit']
+
+
+class InstrumentedStore:
+    def __init__(self, inner, layer, measure_bytes=False):
+        self.inner = inner
+        self.layer = layer
+        self.measure_bytes = measure_bytes
+
+    def __getattr__(self, name):
+        fnc = getattr(self.inner, name)
+        if name not in STATS_OPERATIONS:
+            return fnc
+
+        def instrumented(*args):
+            start = time.perf_counter()
+            try:
+                result = fnc(*args)
+            finally:
+                elapsed = time.perf_counter() - start
+                size = 0
+                if self.measure_bytes:
+                    if name in ('write', 'write_meta'):
+                        size = len(json.dumps(args[1]))
+                    elif name in ('read', 'read_meta'):
+                        size = len(json.dumps(result)) if sys.exc_info()[0] is None else 0
+                record_operation(f'{self.layer}.{name}', size, elapsed)
+            return result
+        return instrumented
+
+
+def new_stats():
+    return {'commands': 0, 'time': 0.0, 'operations': {}}
+
+
+def record_operation(operation, size, elapsed):
+    for entry in (stats['last'], stats['session']):
+        counts = entry['operations'].setdefault(operation, [0, 0, 0.0])
+        counts[0] += 1
+        counts[1] += size
+        counts[2] += elapsed
+
+
+def enable_stats():
+    global stats, store
+    if stats is not None:
+        return
+    stats = {'last': new_stats(), 'session': new_stats(), 'command': None}
+    store.store = InstrumentedStore(store.store, 'backend', measure_bytes=True)
+    store = InstrumentedStore(store, 'cache')
+
+
+def disable_stats():
+    global stats, store
+    if stats is None:
+        return
+    store = store.inner
+    store.store = store.store.inner
+    stats = None
+
+
+def format_stats(entry):
+    lines = [f'{entry["commands"]} commands, {entry["time"] * 1000:.2f} ms']
+    for operation, (count, size, elapsed) in sorted(entry['operations'].items()):
+        size_text = f'{size} B' if size else '-'
+        lines.append(f'  {operation:<18} {count:>7} calls {size_text:>12} {elapsed * 1000:>10.2f} ms')
+    return '\n'.join(lines)
+
+
+@command('stats', '[on|off]', 'Show call counts, bytes and time of the last command and the session')
+def show_stats(params, config):
+    if params == ['on']:
+        enable_stats()
+        return
+    if params == ['off']:
+        disable_stats()
+        return
+    if params:
+        perror('Usage: stats [on|off]')
+        return
+    if stats is None:
+        perror('Statistics are disabled! Try: stats on')
+        return
+    print_stats()
+
+
+def print_stats(file=None):
+    if file is None:
+        file = sys.stdout
+    print(f'Last command: {stats["command"] or "-"}', file=file)
+    print(format_stats(stats['last']), file=file)
+    print('Session:', file=file)
+    print(format_stats(stats['session']), file=file)
+
+
+def run_command(cmd, params, config):
+    try:
+        execute_command(cmd, params, config)
+    except InputNeeded as request:
+        config['answer'] = ask_user(request.kind, request.text)
+        try:
+            execute_command(cmd, params, config)
+        finally:
+            del config['answer']
+
+
+def execute_command(cmd, params, config):
+    if stats is not None and cmd != 'stats':
+        stats['command'] = ' '.join([cmd] + params)
+        stats['last'] = new_stats()
+        start = time.perf_counter()
+        try:
+            dispatch_command(cmd, params, config)
+        finally:
+            elapsed = time.perf_counter() - start
+            for entry in (stats['last'], stats['session']):
+                entry['commands'] += 1
+                entry['time'] += elapsed
+    else:
+        dispatch_command(cmd, params, config)
+
+
+def dispatch_command(cmd, params, config):
+    try:
+        with transaction():
+            if 'current' in config:
+                refresh_stale_current(config)
+            with undo_step(cmd, params):
+                commands[cmd]['fnc'](params, config)
+    except CommandError as err:
+        refresh_current(config)
+        perror(err)
+
+
+def print_help():
+    global help_text
+    if help_text is None:
+        lines = ['Author: Igor Santarek :Poland:', '\nAvailable commands:']
+        lines.extend(commands[name]['help_msg'] for name in commands)
+        lines.append('\n[id] - optional with braces. Without the number is required.')
+        help_text = emojize('\n'.join(lines)) + '\n'
+    sys.stdout.write(help_text)
+
+
+def run_batch(lines, config, keep_going=False):
+    failed = 0
+    with transaction():
+        for line_no, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            cmd, *params = line.split(' ')
+            if cmd == 'exit':
+                break
+            errors = error_count
+            if cmd in commands:
+                run_command(cmd, params, config)
+            else:
+                perror(f'Unknown command {cmd}!')
+            if error_count != errors:
+                print(f'Error in line {line_no}: {line}', file=sys.stderr)
+                failed += 1
+                if not keep_going:
+                    break
+    return 1 if failed else 0
+
+
+def batch_main(args):
+    keep_going = '--keep-going' in args
+    args = [arg for arg in args if arg != '--keep-going']
+    if len(args) > 1:
+        err_die('Usage: tasks batch [file|-] [--keep-going]')
+    config = {'quiet': True, 'assume_yes': True}
+    init_config(config)
+    if not args or args[0] == '-':
+        return run_batch(sys.stdin, config, keep_going)
+    with open(args[0], 'r', encoding='utf-8') as file:
+        return run_batch(file, config, keep_going)
+
+
+def one_shot_main(cmd, params):
+    config = {'quiet': True, 'anywhere': True}
+    init_config(config)
+    errors = error_count
+    if profile_path is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(run_command, cmd, params, config)
+        profiler.dump_stats(profile_path)
+    else:
+        run_command(cmd, params, config)
+    if stats is not None:
+        print_stats(sys.stderr)
+    return 1 if error_count != errors else 0
+
+
+class TaskServer:
+    def __init__(self):
+        self.batch = None
+        self.sessions = 0
+
+    async def serve(self):
+        import asyncio
+        import signal
+        server = await asyncio.start_unix_server(self.handle, SOCKET_PATH)
+        os.chmod(SOCKET_PATH, 0o600)
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+        print(f'Serving tasks on {SOCKET_PATH}')
+        async with server:
+            await stop
+
+    async def handle(self, reader, writer):
+        self.sessions += 1
+        config = {'owner': f'{os.getpid()}-{self.sessions}'}
+        shell = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                if 'current' not in config:
+                    shell = request.get('shell', False)
+                    if not shell:
+                        config.update(quiet=True, anywhere=True)
+                    init_config(config)
+                writer.write((json.dumps(self.execute(request, config)) + '\n').encode('utf-8'))
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            if shell:
+                self.begin_batch()
+                end_running_timers(config['owner'])
+            writer.close()
+
+    def execute(self, request, config):
+        if 'complete' in request:
+            return {'matches': run_completion(request['complete'], request['begidx'], config)}
+        cmd, params = request['cmd'], request.get('params', [])
+        if cmd not in commands or cmd == 'exit':
+            return {'err': f'Unknown command {cmd}!\n', 'failed': True}
+        self.begin_batch()
+        if 'answer' in request:
+            config['answer'] = request['answer']
+        out, err = io.StringIO(), io.StringIO()
+        errors = error_count
+        try:
+            with redirect_stdout(out), redirect_stderr(err):
+                execute_command(cmd, params, config)
+        except InputNeeded as needed:
+            return {'input': needed.kind, 'text': needed.text}
+        except Exception as exc:
+            err.write(f'{exc}\n')
+            errors = -1
+        finally:
+            config.pop('answer', None)
+        return {
+            'out': out.getvalue(),
+            'err': err.getvalue(),
+            'failed': error_count != errors,
+            'prompt': '/'.join(config['name_history']),
+        }
+
+    def begin_batch(self):
+        if self.batch is None:
+            import asyncio
+            self.batch = transaction()
+            self.batch.__enter__()
+            asyncio.get_running_loop().call_later(SERVER_FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        batch, self.batch = self.batch, None
+        if batch is not None:
+            try:
+                batch.__exit__(None, None, None)
+            except Exception as err:
+                perror(f'Could not save changes: {err}')
+
+
+def serve_main():
+    if os.name == 'nt':
+        err_die('Server mode needs Unix domain sockets!')
+    import asyncio
+    server = connect_server()
+    if server is not None:
+        server.close()
+        err_die('Server is already running!')
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    for task_id in get_all_tasks():
+        read_task(task_id)
+    task_server = TaskServer()
+    try:
+        asyncio.run(task_server.serve())
+    finally:
+        task_server.flush()
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+    return 0
+
+
+def connect_server():
+    import socket
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(SOCKET_PATH):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(SOCKET_PATH)
+    except OSError:
+        connection.close()
+        return None
+    return connection.makefile('rwb')
+
+
+def remote_command(server, cmd, params, shell):
+    request = {'cmd': cmd, 'params': params, 'shell': shell}
+    while True:
+        server.write((json.dumps(request) + '\n').encode('utf-8'))
+        server.flush()
+        line = server.readline()
+        if not line:
+            err_die('Server closed the connection!')
+        reply = json.loads(line)
+        if 'input' not in reply:
+            break
+        request['answer'] = ask_user(reply['input'], reply['text'])
+    sys.stdout.write(reply.get('out', ''))
+    sys.stderr.write(reply.get('err', ''))
+    return reply
+
+
+def remote_complete(server, line, begidx):
+    server.write((json.dumps({'complete': line, 'begidx': begidx}) + '\n').encode('utf-8'))
+    server.flush()
+    return json.loads(server.readline() or '{}').get('matches', [])
+
+
+def client_main(server, args):
+    if args and args[0] in commands:
+        return 1 if remote_command(server, args[0], args[1:], False)['failed'] else 0
+
+    prompt = remote_command(server, 'see', [], True)['prompt']
+
+    if os.name != 'nt':
+        setup_completion(lambda line, begidx: remote_complete(server, line, begidx))
+
+    while True:
+        cmd, *params = input(emojize(f'{prompt}> ')).split(' ')
+
+        if cmd == 'exit':
+            return 0
+        if cmd in commands:
+            prompt = remote_command(server, cmd, params, True).get('prompt', prompt)
+        else:
+            print_help()
 
 
 if __name__ == '__main__':
+    if '--plain' in sys.argv:
+        sys.argv.remove('--plain')
+        plain = True
+    if '--profile' in sys.argv:
+        index = sys.argv.index('--profile')
+        if index + 1 >= len(sys.argv):
+            err_die('Usage: tasks --profile FILE command [params]')
+        profile_path = sys.argv[index + 1]
+        del sys.argv[index:index + 2]
     if len(sys.argv) == 2 and sys.argv[1] == 'init':
         init()
     if not is_initialized():
         err_die('Not initialized!\nTry: tasks init')
+    if not (plain or profile_path is not None or os.environ.get('TASKS_STATS')
+            or sys.argv[1:2] in (['batch'], ['migrate'], ['serve'])):
+        server = connect_server()
+        if server is not None:
+            exit(client_main(server, sys.argv[1:]))
+    if len(sys.argv) == 3 and sys.argv[1] == 'migrate':
+        open_store(sys.argv[2])
+    elif store is None:
+        open_store()
+    upgrade_tree()
+    if os.environ.get('TASKS_STATS'):
+        enable_stats()
+
+    if sys.argv[1:] == ['serve']:
+        exit(serve_main())
+    if len(sys.argv) >= 2 and sys.argv[1] == 'batch':
+        exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) >= 2 and sys.argv[1] in commands:
+        exit(one_shot_main(sys.argv[1], sys.argv[2:]))
 
     atexit.register(end_work_in_all_tasks)
     config = {}
@@ -790,15 +3505,14 @@ if __name__ == '__main__':
 
     see([], config)
 
+    if os.name != 'nt':
+        setup_completion(lambda line, begidx: run_completion(line, begidx, config))
+
     while True:
         curr_path = '/'.join(config['name_history'])
-        cmd, *params = input(emoji.emojize(f'{curr_path}> ')).split(' ')
+        cmd, *params = input(emojize(f'{curr_path}> ')).split(' ')
 
         if cmd in commands:
-            commands[cmd]['fnc'](params, config)
+            run_command(cmd, params, config)
         else:
-            print(emoji.emojize('Author: Igor Santarek :Poland:'))
-            print('\nAvailable commands:')
-            for name in commands:
-                print(commands[name]['help_msg'])
-            print('\n[id] - optional with braces. Without the number is required.')
+            print_help()